@@ -0,0 +1,124 @@
+import asyncio
+import io
+import os
+from collections import OrderedDict
+from typing import Awaitable, Callable
+
+
+def attachment_id(url: str) -> int | None:
+    """Returns the attachment snowflake of a Discord attachment URL (.../attachments/<channel>/<attachment>/<name>)."""
+    parts = url.split('?', 1)[0].split('/')
+    if len(parts) < 4 or parts[-4] != 'attachments' or not parts[-2].isnumeric():
+        return None
+    return int(parts[-2])
+
+
+class AttachmentArchive:
+    """Size-bounded on-disk LRU of attachment files, keyed by attachment id.
+
+    prefetch downloads an attachment in the background as soon as its message is cached, so a log written after the
+    message is deleted reads local bytes instead of racing the CDN. Files live in directory as one file per id; the
+    least recently used ones are removed once their total passes max_bytes. The index is rebuilt from the directory,
+    oldest modification time first, when the bot starts. read waits at most max_wait seconds for a prefetch that is
+    still running, so a slow prefetch costs a log no more than that before it downloads the file itself.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, download: Callable[[str], Awaitable[io.BytesIO | None]],
+                 max_wait: float):
+        self.directory: str = directory
+        self.max_bytes: int = max_bytes
+        self.max_wait: float = max_wait
+        self.hits: int = 0
+        self.misses: int = 0
+        self._download: Callable[[str], Awaitable[io.BytesIO | None]] = download
+        self._files: OrderedDict[int, int] = OrderedDict()
+        self._bytes: int = 0
+        self._fetches: dict[int, asyncio.Task] = {}
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(directory):
+            if name.isnumeric():
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, int(name), stat.st_size))
+        for _, file_id, size in sorted(entries):
+            self._files[file_id] = size
+            self._bytes += size
+
+    def __len__(self) -> int:
+        return len(self._files)
+
+    def size(self) -> int:
+        return self._bytes
+
+    def prefetch(self, url: str):
+        file_id = attachment_id(url)
+        if file_id is not None and file_id not in self._files and file_id not in self._fetches:
+            self._fetches[file_id] = asyncio.create_task(self._fetch(file_id, url))
+
+    async def read(self, url: str) -> io.BytesIO | None:
+        """Returns the archived bytes of an attachment, waiting up to max_wait for its prefetch if one is still
+        running, or None if it is not archived by then."""
+        file_id = attachment_id(url)
+        if file_id is None:
+            return None
+        if file_id in self._fetches:
+            try:
+                await asyncio.wait_for(asyncio.shield(self._fetches[file_id]), self.max_wait)
+            except asyncio.TimeoutError:
+                self.misses += 1
+                return None
+        if file_id not in self._files:
+            self.misses += 1
+            return None
+        self._files.move_to_end(file_id)
+        try:
+            data = await asyncio.to_thread(self._read_file, file_id)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return data
+
+    def _path(self, file_id: int) -> str:
+        return os.path.join(self.directory, str(file_id))
+
+    async def _fetch(self, file_id: int, url: str):
+        try:
+            data = await self._download(url)
+            if data is None or data.getbuffer().nbytes > self.max_bytes:
+                return
+            try:
+                await asyncio.to_thread(self._write_file, file_id, data.getvalue())
+            except OSError:
+                return
+            self._files[file_id] = data.getbuffer().nbytes
+            self._bytes += data.getbuffer().nbytes
+            victims = []
+            while self._bytes > self.max_bytes:
+                victim, size = self._files.popitem(last=False)
+                self._bytes -= size
+                victims.append(victim)
+            if len(victims) > 0:
+                await asyncio.to_thread(self._remove_files, victims)
+        finally:
+            del self._fetches[file_id]
+
+    def _read_file(self, file_id: int) -> io.BytesIO:
+        path = self._path(file_id)
+        with open(path, 'rb') as archived_file:
+            data = io.BytesIO(archived_file.read())
+        os.utime(path)
+        return data
+
+    def _write_file(self, file_id: int, data: bytes):
+        tmp_path = self._path(file_id) + '.tmp'
+        with open(tmp_path, 'wb') as archived_file:
+            archived_file.write(data)
+        os.replace(tmp_path, self._path(file_id))
+
+    def _remove_files(self, file_ids: list[int]):
+        for file_id in file_ids:
+            try:
+                os.remove(self._path(file_id))
+            except FileNotFoundError:
+                pass
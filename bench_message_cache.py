@@ -0,0 +1,332 @@
+# Microbenchmarks for MessageCache and MessageModel.
+# Usage: python bench_message_cache.py [engine|memory|snapshot|load|backfill|stress] [number of messages]
+
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from cache_snapshot import open_snapshot, read_snapshot, write_snapshot
+from columnar_message_store import ColumnarMessageStore
+from message_cache import MessageCache
+from message_model import MessageModel
+from message_store import IndexedMessageStore
+from snapshot_message_store import SnapshotMessageStore
+
+
+class ListMessageCache:
+    """The original flat sorted list engine, kept as a baseline for comparison."""
+
+    def __init__(self, max_cache_size: int):
+        self._cache: list[MessageModel] = []
+        self._max_cache_size = max_cache_size
+
+    def add_message_model(self, message: MessageModel, append: bool = True):
+        if len(self._cache) == 0:
+            self._cache.append(message)
+        elif append:
+            if not self._cache[len(self._cache) - 1].total_eq(message):
+                self._cache.append(message)
+        else:
+            left: int = 0
+            right: int = len(self._cache) - 1
+            while left <= right:
+                mid = (left + right) // 2
+                if self._cache[mid] < message:
+                    left = mid + 1
+                elif self._cache[mid] > message:
+                    right = mid - 1
+                else:
+                    left = mid
+                    break
+            if left >= len(self._cache) or not self._cache[left].total_eq(message):
+                self._cache.insert(left, message)
+
+    def get_message_model(self, message: MessageModel, update: bool = False,
+                          delete: bool = False) -> MessageModel | None:
+        left: int = 0
+        right: int = len(self._cache) - 1
+        while left <= right:
+            mid = (left + right) // 2
+            if self._cache[mid] < message:
+                left = mid + 1
+            elif self._cache[mid] > message:
+                right = mid - 1
+            else:
+                ret_value = self._cache[mid]
+                if update:
+                    self._cache[mid] = message
+                if delete:
+                    del self._cache[mid]
+                return ret_value
+        return None
+
+
+class LegacyMessageModel:
+    """The original dict-backed model layout, kept as a baseline for the memory benchmark."""
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs['dict'])
+        self.attachments = [tuple(attachment) for attachment in self.attachments]
+
+
+def make_dict(message_id: int, channel_id: int, rng: random.Random) -> dict:
+    content = ' '.join(['word'] * rng.randrange(1, 20)) if rng.random() < 0.95 else '*[Empty message body]*'
+    attachments = ([[f'https://media.discordapp.net/attachments/{channel_id}/{message_id + 1}/image.png', False]]
+                   if rng.random() < 0.1 else [])
+    reply_url = (f'https://discord.com/channels/1/{channel_id}/{message_id - (1 << 22)}'
+                 if rng.random() < 0.2 else '')
+    return {'message_id': message_id, 'channel_id': channel_id, 'user_id': rng.randrange(1 << 60),
+            'content': content, 'sticker': 0, 'attachments': attachments, 'reply_url': reply_url}
+
+
+def make_model(message_id: int, channel_id: int) -> MessageModel:
+    return MessageModel(dict={'message_id': message_id, 'channel_id': channel_id, 'user_id': 1,
+                              'content': f'message {message_id}', 'sticker': 0, 'attachments': [],
+                              'reply_url': ''})
+
+
+def make_models(num_messages: int) -> list[MessageModel]:
+    base = 1000000000000000000
+    return [make_model(base + (i << 22), i % 50) for i in range(num_messages)]
+
+
+def timed(label: str, func) -> float:
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'  {label:<28}{round(elapsed, 3)}s')
+    return elapsed
+
+
+def bench_engine(name: str, cache, models: list[MessageModel]):
+    shuffled = list(models)
+    random.Random(0).shuffle(shuffled)
+    probes = shuffled[:min(len(shuffled), 50000)]
+    print(name)
+
+    def backfill():
+        for model in shuffled:
+            cache.add_message_model(model, append=False)
+
+    def lookup():
+        for model in probes:
+            cache.get_message_model(model)
+
+    def update():
+        for model in probes:
+            cache.get_message_model(model, update=True)
+
+    def delete():
+        for model in probes:
+            cache.get_message_model(model, delete=True)
+
+    timed('out-of-order insert', backfill)
+    timed(f'lookup x{len(probes)}', lookup)
+    timed(f'update x{len(probes)}', update)
+    timed(f'delete x{len(probes)}', delete)
+
+
+def measure_models(name: str, model_type, cache_text: str):
+    # models are built from a freshly parsed cache file, the same way MessageCache loads one, so strings the model
+    # keeps from the parsed dicts are counted and the ones it drops are not
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    models = [model_type(dict=model_dict) for model_dict in json.loads(cache_text)]
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'  {name:<28}{round(allocated / len(models), 1)} bytes/entry')
+
+
+def measure_store(name: str, cache_type, cache_text: str, num_messages: int):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    cache = cache_type(max_cache_size=num_messages, cache=json.loads(cache_text))
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f'  {name:<28}{round(allocated / cache.len(), 1)} bytes/entry')
+
+
+def bench_memory(num_messages: int):
+    rng = random.Random(0)
+    base = 1000000000000000000
+    cache_text = json.dumps([make_dict(base + (i << 22), 1000 + i % 50, rng) for i in range(num_messages)])
+    print('memory')
+    measure_models('dict-backed model', LegacyMessageModel, cache_text)
+    measure_models('slotted model', MessageModel, cache_text)
+    measure_store('indexed store', MessageCache, cache_text, num_messages)
+    measure_store('columnar store', lambda **kwargs: MessageCache(store=ColumnarMessageStore(), **kwargs),
+                  cache_text, num_messages)
+
+
+def write_json(path: str, models: list[MessageModel]):
+    # the hourly cache dump as it was before binary snapshots
+    cache_file = open(path, 'w')
+    cache_file.write(json.dumps(models, default=lambda o: o.to_dict(), indent=4))
+    cache_file.close()
+
+
+def snapshot_worker(writer_name: str, num_messages: int, path: str) -> tuple[float, int, int]:
+    rng = random.Random(0)
+    base = 1000000000000000000
+    models = [MessageModel(dict=make_dict(base + (i << 22), 1000 + i % 50, rng)) for i in range(num_messages)]
+    writer = write_json if writer_name == 'json' else write_snapshot
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    writer(path, models)
+    elapsed = time.perf_counter() - start
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    return elapsed, os.path.getsize(path), rss_growth
+
+
+def bench_snapshot(num_messages: int):
+    # each writer runs in a fresh process so its peak RSS is not hidden by an earlier run's peak
+    context = multiprocessing.get_context('spawn')
+    print('snapshot')
+    with tempfile.TemporaryDirectory() as directory:
+        for writer_name in ['json', 'binary']:
+            with context.Pool(1) as pool:
+                elapsed, size, rss_growth = pool.apply(snapshot_worker, (writer_name, num_messages,
+                                                                         os.path.join(directory, writer_name)))
+            print(f'  {writer_name:<28}{round(elapsed, 3)}s, {size} bytes, peak RSS +{rss_growth} KiB')
+
+
+def bench_load(num_messages: int):
+    rng = random.Random(0)
+    base = 1000000000000000000
+    models = [MessageModel(dict=make_dict(base + (i << 22), 1000 + i % 50, rng)) for i in range(num_messages)]
+    print('load')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'cache.bin')
+        write_snapshot(path, models)
+        timed('eager', lambda: MessageCache(max_cache_size=num_messages, cache=read_snapshot(path)))
+        snapshot = open_snapshot(path)
+        timed('memory-mapped', lambda: MessageCache(max_cache_size=num_messages,
+                                                    store=SnapshotMessageStore(snapshot, IndexedMessageStore())))
+        snapshot.close()
+
+
+def bench_engines(num_messages: int):
+    models = make_models(num_messages)
+    bench_engine('flat list', ListMessageCache(max_cache_size=num_messages), models)
+    bench_engine('indexed', MessageCache(max_cache_size=num_messages), models)
+    bench_engine('columnar', MessageCache(max_cache_size=num_messages, store=ColumnarMessageStore()), models)
+
+
+def bench_backfill(num_messages: int):
+    # one channel's history at a time, oldest first, in pages of backfill_batch_size as populate_cache does
+    models = make_models(num_messages)
+    channels = {}
+    for model in models:
+        channels.setdefault(model.channel_id, []).append(model)
+    batch_size = 1000
+    for name, store_type in [('indexed', IndexedMessageStore), ('columnar', ColumnarMessageStore)]:
+        print(name)
+
+        def one_by_one():
+            cache = MessageCache(max_cache_size=num_messages, store=store_type())
+            for history in channels.values():
+                for model in history:
+                    cache.add_message_model(model, append=False)
+
+        def bulk():
+            cache = MessageCache(max_cache_size=num_messages, store=store_type())
+            for history in channels.values():
+                for start in range(0, len(history), batch_size):
+                    cache.bulk_add(history[start:start + batch_size])
+
+        timed('add_message_model', one_by_one)
+        timed(f'bulk_add x{batch_size}', bulk)
+
+
+async def check_snapshot(task: asyncio.Task, path: str, expected: list[dict]):
+    await task
+    assert [dict(entry, attachments=[tuple(url) for url in entry['attachments']])
+            for entry in read_snapshot(path)] == expected
+    os.remove(path)
+
+
+async def replay_events(name: str, store_type, num_events: int, snapshot_every: int):
+    # a synthetic event stream of new messages, edits, deletes and lookups, checked against a plain dict, with
+    # snapshots of the cache written from a worker thread while the stream keeps going
+    rng = random.Random(0)
+    cache = MessageCache(max_cache_size=num_events, store=store_type())
+    reference: dict[int, MessageModel] = {}
+    live_ids: list[int] = []
+    next_id = 1000000000000000000
+    snapshots = []
+    longest_step = 0
+    longest_view = 0
+    directory = tempfile.mkdtemp()
+    start = time.perf_counter()
+    for event in range(num_events):
+        step_start = time.perf_counter()
+        kind = rng.random()
+        if kind < 0.7 or len(live_ids) == 0:
+            next_id += 1 << 22
+            model = make_model(next_id, rng.randrange(50))
+            cache.add_message_model(model)
+            reference[next_id] = model
+            live_ids.append(next_id)
+        elif kind < 0.85:
+            message_id = live_ids[rng.randrange(len(live_ids))]
+            model = MessageModel(dict={**reference[message_id].to_dict(), 'content': f'edit {event}'})
+            assert cache.get_message_model(model, update=True).total_eq(reference[message_id])
+            reference[message_id] = model
+        elif kind < 0.95:
+            index = rng.randrange(len(live_ids))
+            live_ids[index], live_ids[-1] = live_ids[-1], live_ids[index]
+            message_id = live_ids.pop()
+            assert cache.get_message_model(reference.pop(message_id), delete=True) is not None
+        else:
+            message_id = live_ids[rng.randrange(len(live_ids))]
+            assert cache.get_message_model(reference[message_id]).total_eq(reference[message_id])
+        longest_step = max(longest_step, time.perf_counter() - step_start)
+        if event % snapshot_every == snapshot_every - 1:
+            expected = [reference[message_id].to_dict() for message_id in sorted(reference)]
+            view_start = time.perf_counter()
+            view = cache.view()
+            longest_view = max(longest_view, time.perf_counter() - view_start)
+            # each snapshot gets its own file, since writes from overlapping threads would share the temp file
+            path = os.path.join(directory, f'stress{event}.bin')
+            snapshots.append((asyncio.create_task(asyncio.to_thread(write_snapshot, path, view)), path, expected))
+        if event % 100 == 0:
+            await asyncio.sleep(0)
+        while len(snapshots) > 0 and snapshots[0][0].done():
+            await check_snapshot(*snapshots.pop(0))
+    for snapshot in snapshots:
+        await check_snapshot(*snapshot)
+    elapsed = time.perf_counter() - start
+    assert [model.to_dict() for model in cache.get_cache()] == [reference[message_id].to_dict()
+                                                                 for message_id in sorted(reference)]
+    print(f'  {name:<28}{round(num_events / elapsed)} events/s with checks, longest event '
+          f'{round(longest_step * 1000, 2)}ms, longest view {round(longest_view * 1000, 2)}ms')
+
+
+def bench_stress(num_messages: int):
+    print('event stream replay')
+    for name, store_type in [('indexed', IndexedMessageStore), ('columnar', ColumnarMessageStore)]:
+        asyncio.run(replay_events(name, store_type, num_messages, snapshot_every=max(1, num_messages // 10)))
+
+
+benchmarks = {'engine': bench_engines, 'memory': bench_memory, 'snapshot': bench_snapshot,
+              'load': bench_load, 'backfill': bench_backfill, 'stress': bench_stress}
+
+
+def main():
+    names = [arg for arg in sys.argv[1:] if arg in benchmarks] or list(benchmarks.keys())
+    counts = [int(arg) for arg in sys.argv[1:] if arg.isnumeric()]
+    num_messages = counts[0] if len(counts) > 0 else 300000
+    print(f'{num_messages} messages')
+    for name in names:
+        benchmarks[name](num_messages)
+
+
+if __name__ == '__main__':
+    main()
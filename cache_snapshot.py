@@ -0,0 +1,235 @@
+import mmap
+import os
+import struct
+from array import array
+from typing import Iterable, Iterator
+
+from message_model import MessageModel
+
+# A snapshot is the magic header and the write-ahead log generation it covers, followed by one length-prefixed record
+# per message, oldest first. Each record holds the fixed-width ids, the UTF-8 content, and the attachments as
+# (spoiler flag, URL) pairs. After the records comes an index of four 8-byte aligned columns (message ids, channel
+# ids, record offsets, model sizes), and a footer pointing at the end of the records and at the index, so the file
+# can be memory-mapped and searched without decoding any record. Version 1 snapshots have no generation field and
+# version 2 snapshots have no index.
+_magic_v1 = b'CLSC\x01'
+_magic_v2 = b'CLSC\x02'
+_magic = b'CLSC\x03'
+_generation = struct.Struct('<Q')
+_length = struct.Struct('<I')
+_footer = struct.Struct('<QQQ4s')
+_footer_magic = b'CLSI'
+_fields = struct.Struct('<QQQQQI')
+_attachment = struct.Struct('<?H')
+
+_write_buffer_size = 1 << 20
+_path_prefix = 'cache.'
+_path_suffix = '.bin'
+_legacy_name = 'cache.bin'
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def frame_record(payload: bytes) -> bytes:
+    return _length.pack(len(payload)) + payload
+
+
+def encode_message(message: MessageModel) -> bytes:
+    content = message.content.encode()
+    parts = [_fields.pack(message.message_id, message.channel_id, message.user_id, message.sticker,
+                          message.reply_id, len(content)), content]
+    attachments = message.attachments
+    parts.append(struct.pack('<H', len(attachments)))
+    for url, is_spoiler in attachments:
+        encoded_url = url.encode()
+        parts.append(_attachment.pack(is_spoiler, len(encoded_url)))
+        parts.append(encoded_url)
+    return b''.join(parts)
+
+
+def decode_message(payload: bytes | memoryview) -> dict:
+    message_id, channel_id, user_id, sticker, reply_id, content_length = _fields.unpack_from(payload, 0)
+    offset = _fields.size
+    content = bytes(payload[offset:offset + content_length]).decode()
+    offset += content_length
+    (num_attachments,) = struct.unpack_from('<H', payload, offset)
+    offset += 2
+    attachments = []
+    for _ in range(num_attachments):
+        is_spoiler, url_length = _attachment.unpack_from(payload, offset)
+        offset += _attachment.size
+        attachments.append((bytes(payload[offset:offset + url_length]).decode(), is_spoiler))
+        offset += url_length
+    return {'message_id': message_id, 'channel_id': channel_id, 'user_id': user_id, 'content': content,
+            'sticker': sticker, 'attachments': attachments, 'reply_id': reply_id}
+
+
+def write_snapshot(path: str, messages: Iterable[MessageModel], generation: int = 0) -> int:
+    """Streams messages, oldest first, into a snapshot file and returns the number of records written.
+
+    generation is the first write-ahead log generation the snapshot does not include. Records are written to a
+    temporary file next to path, which replaces path only once it is complete and synced, so a crash mid-write never
+    leaves a truncated snapshot behind. Blocking; run it off the event loop.
+    """
+    tmp_path = path + '.tmp'
+    ids = array('Q')
+    channels = array('Q')
+    offsets = array('Q')
+    sizes = array('I')
+    with open(tmp_path, 'wb', buffering=_write_buffer_size) as snapshot_file:
+        position = snapshot_file.write(_magic + _generation.pack(generation))
+        for message in messages:
+            ids.append(message.message_id)
+            channels.append(message.channel_id)
+            offsets.append(position)
+            sizes.append(message.__sizeof__())
+            position += snapshot_file.write(frame_record(encode_message(message)))
+        index_offset = position + (-position % 8)
+        snapshot_file.write(bytes(index_offset - position))
+        for column in [ids, channels, offsets, sizes]:
+            snapshot_file.write(column.tobytes())
+        snapshot_file.write(_footer.pack(position, index_offset, len(ids), _footer_magic))
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(tmp_path, path)
+    return len(ids)
+
+
+def snapshot_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, f'{_path_prefix}{generation}{_path_suffix}')
+
+
+def snapshot_generations(directory: str) -> list[int]:
+    """Returns the generations of the complete snapshots in directory, oldest first."""
+    if not os.path.isdir(directory):
+        return []
+    names = [name[len(_path_prefix):-len(_path_suffix)] for name in os.listdir(directory)
+             if name.startswith(_path_prefix) and name.endswith(_path_suffix)]
+    return sorted([int(name) for name in names if name.isnumeric()])
+
+
+def remove_snapshots(directory: str, generation: int):
+    """Deletes the snapshots older than generation, including one written before snapshots were numbered. Blocking."""
+    paths = [snapshot_path(directory, old_generation) for old_generation in snapshot_generations(directory)
+             if old_generation < generation]
+    for path in paths + [os.path.join(directory, _legacy_name)]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except PermissionError:
+            pass  # still mapped on Windows; removed after a later snapshot once it is closed
+
+
+def _record_region(data: bytes | mmap.mmap, path: str) -> tuple[int, int]:
+    """Returns where the records of a snapshot start and end."""
+    if data[:len(_magic_v1)] == _magic_v1:
+        return len(_magic_v1), len(data)
+    if data[:len(_magic_v2)] == _magic_v2:
+        return len(_magic_v2) + _generation.size, len(data)
+    if data[:len(_magic)] != _magic or len(data) < len(_magic) + _generation.size + _footer.size:
+        raise SnapshotError(f'{path} is not a cache snapshot')
+    records_end, _, _, footer_magic = _footer.unpack_from(data, len(data) - _footer.size)
+    if footer_magic != _footer_magic:
+        raise SnapshotError(f'{path} has no index')
+    return len(_magic) + _generation.size, records_end
+
+
+def read_records(data: bytes | memoryview, offset: int) -> Iterator[memoryview]:
+    """Yields the length-prefixed records in data from offset on, stopping early if the last one is truncated."""
+    view = memoryview(data)
+    while offset + _length.size <= len(view):
+        (record_length,) = _length.unpack_from(view, offset)
+        offset += _length.size
+        if offset + record_length > len(view):
+            return
+        yield view[offset:offset + record_length]
+        offset += record_length
+
+
+def snapshot_generation(path: str) -> int:
+    with open(path, 'rb') as snapshot_file:
+        header = snapshot_file.read(len(_magic) + _generation.size)
+    if header.startswith(_magic) or header.startswith(_magic_v2):
+        return _generation.unpack_from(header, len(_magic))[0]
+    if header.startswith(_magic_v1):
+        return 0
+    raise SnapshotError(f'{path} is not a cache snapshot')
+
+
+def read_snapshot(path: str) -> Iterator[dict]:
+    """Yields the messages in a snapshot file as dicts accepted by MessageModel(dict=...)."""
+    with open(path, 'rb') as snapshot_file:
+        data = snapshot_file.read()
+    start, end = _record_region(data, path)
+    view = memoryview(data)[:end]
+    num_bytes = start
+    for record in read_records(view, start):
+        num_bytes += _length.size + len(record)
+        yield decode_message(record)
+    if num_bytes != end:
+        raise SnapshotError(f'{path} ends in the middle of a record')
+
+
+class MappedSnapshot:
+    """Read-only, memory-mapped view of an indexed snapshot.
+
+    Opening one only maps the file and slices the index columns out of it, so the ids and channels of every message
+    are available at once; a record is decoded only when message is called for its row.
+    """
+
+    def __init__(self, path: str):
+        self._references: int = 1
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            _record_region(self._map, path)
+            if self._map[:len(_magic)] != _magic:
+                raise SnapshotError(f'{path} has no index')
+        except SnapshotError:
+            self.close()
+            raise
+        self.generation: int = _generation.unpack_from(self._map, len(_magic))[0]
+        _, index_offset, count, _ = _footer.unpack_from(self._map, len(self._map) - _footer.size)
+        self._view = memoryview(self._map)
+        self.ids: memoryview = self._view[index_offset:index_offset + 8 * count].cast('Q')
+        self.channels: memoryview = self._view[index_offset + 8 * count:index_offset + 16 * count].cast('Q')
+        self.offsets: memoryview = self._view[index_offset + 16 * count:index_offset + 24 * count].cast('Q')
+        self.sizes: memoryview = self._view[index_offset + 24 * count:index_offset + 28 * count].cast('I')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def message(self, row: int) -> dict:
+        offset = self.offsets[row]
+        (record_length,) = _length.unpack_from(self._map, offset)
+        return decode_message(self._view[offset + _length.size:offset + _length.size + record_length])
+
+    def acquire(self) -> 'MappedSnapshot':
+        self._references += 1
+        return self
+
+    def close(self):
+        # releases one reference; the file is unmapped once the last holder closes it
+        self._references -= 1
+        if self._references > 0:
+            return
+        for column in ['ids', 'channels', 'offsets', 'sizes', '_view']:
+            if hasattr(self, column):
+                getattr(self, column).release()
+        self._map.close()
+        self._file.close()
+
+
+def open_snapshot(path: str) -> MappedSnapshot | None:
+    """Maps an indexed snapshot, or returns None for snapshots written before the index existed."""
+    try:
+        return MappedSnapshot(path)
+    except SnapshotError:
+        with open(path, 'rb') as snapshot_file:
+            header = snapshot_file.read(len(_magic))
+        if header == _magic_v1 or header == _magic_v2:
+            return None
+        raise
@@ -0,0 +1,133 @@
+import collections
+import os
+import struct
+import threading
+
+from cache_snapshot import decode_message, encode_message, frame_record, read_records
+from message_model import MessageModel
+
+_put = ord('P')
+_delete = ord('D')
+_message_id = struct.Struct('<Q')
+_prefix = 'cache.wal.'
+
+
+class _Rotation:
+    def __init__(self, generation: int):
+        self.generation: int = generation
+
+
+class CacheWal:
+    """Append-only write-ahead log of cache changes.
+
+    Every put or delete on the cache is encoded on the event loop and queued in memory. flush, which is blocking and
+    meant to run off the loop, writes everything queued in one batch and syncs the file, so write I/O follows churn
+    instead of cache size.
+
+    The log is split into numbered generations, one file each. rotate starts a new generation; a snapshot taken
+    right after it contains every change from older generations, and checkpoint deletes them once it is on disk.
+    """
+
+    def __init__(self, directory: str, generation: int):
+        self.directory: str = directory
+        self.generation: int = generation
+        self.records_written: int = 0
+        self._queue: collections.deque = collections.deque()
+        self._io_lock: threading.Lock = threading.Lock()
+        self._file = None
+        self._file_generation: int = generation
+
+    @staticmethod
+    def path(directory: str, generation: int) -> str:
+        return os.path.join(directory, f'{_prefix}{generation}')
+
+    @staticmethod
+    def generations(directory: str) -> list[int]:
+        if not os.path.isdir(directory):
+            return []
+        return sorted([int(name[len(_prefix):]) for name in os.listdir(directory)
+                       if name.startswith(_prefix) and name[len(_prefix):].isnumeric()])
+
+    def append_put(self, message: MessageModel):
+        self._queue.append(frame_record(bytes([_put]) + encode_message(message)))
+
+    def append_delete(self, message_id: int):
+        self._queue.append(frame_record(bytes([_delete]) + _message_id.pack(message_id)))
+
+    def rotate(self) -> int:
+        """Starts a new generation and returns its number. Cheap; call it on the loop right before taking a snapshot."""
+        self.generation += 1
+        self._queue.append(_Rotation(self.generation))
+        return self.generation
+
+    def flush(self) -> int:
+        """Writes and syncs every queued record and returns how many there were. Blocking."""
+        with self._io_lock:
+            return self._drain()
+
+    def checkpoint(self, generation: int):
+        """Deletes the generations before generation, once a snapshot containing them is on disk. Blocking."""
+        with self._io_lock:
+            self._drain()
+            for old_generation in self.generations(self.directory):
+                if old_generation < generation:
+                    os.remove(self.path(self.directory, old_generation))
+
+    def close(self):
+        with self._io_lock:
+            self._drain()
+            self._close_file()
+
+    def _drain(self) -> int:
+        num_records = 0
+        batch = []
+        while len(self._queue) > 0:
+            item = self._queue.popleft()
+            if isinstance(item, _Rotation):
+                self._write(batch)
+                batch = []
+                self._close_file()
+                self._file_generation = item.generation
+            else:
+                batch.append(item)
+                num_records += 1
+        self._write(batch)
+        self.records_written += num_records
+        return num_records
+
+    def _write(self, batch: list[bytes]):
+        if len(batch) > 0:
+            if self._file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self._file = open(self.path(self.directory, self._file_generation), 'ab')
+            self._file.write(b''.join(batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def _close_file(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def replay_wal(directory: str, first_generation: int, cache) -> int:
+    """Applies the logged changes of every generation from first_generation on to cache, oldest first.
+
+    A record cut short by a crash ends its generation's replay. Returns the number of records applied.
+    """
+    num_records = 0
+    for generation in CacheWal.generations(directory):
+        if generation < first_generation:
+            continue
+        with open(CacheWal.path(directory, generation), 'rb') as wal_file:
+            data = wal_file.read()
+        for record in read_records(data, 0):
+            if record[0] == _put:
+                cache.add_message_model(MessageModel(dict=decode_message(record[1:])), append=False)
+            elif record[0] == _delete:
+                (message_id,) = _message_id.unpack_from(record, 1)
+                cache.get_message_model(MessageModel(dict={'message_id': message_id, 'channel_id': 0, 'user_id': 0,
+                                                           'content': '', 'sticker': 0, 'attachments': [],
+                                                           'reply_id': 0}), delete=True)
+            num_records += 1
+    return num_records
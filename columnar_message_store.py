@@ -0,0 +1,207 @@
+import bisect
+from array import array
+
+from message_model import MessageModel
+from message_store import MessageStore
+
+
+class ColumnarMessageStore(MessageStore):
+    """Message store that keeps the cache in parallel arrays instead of one Python object per message.
+
+    The integer fields live in sorted array('Q') columns, and content and attachment URLs are packed as UTF-8 into a
+    single bytearray arena that rows point into. Models are only built when a message is actually read. A cached
+    message costs roughly 60 bytes of columns plus its encoded text, against a few hundred bytes as a MessageModel.
+
+    New messages are staged in a small pending dict and merged into the columns in sorted batches with slice copies,
+    so neither live appends nor out-of-order backfill shift the whole arrays per message. Removed rows are only
+    tombstoned; the columns and arena are compacted once at least half of the rows are dead.
+    """
+    _merge_threshold: int = 1024
+    _min_compact_rows: int = 4096
+
+    def __init__(self):
+        self._ids: array = array('Q')
+        self._channels: array = array('Q')
+        self._users: array = array('Q')
+        self._stickers: array = array('Q')
+        self._replies: array = array('Q')
+        self._offsets: array = array('Q')
+        self._content_sizes: array = array('I')
+        self._attachment_sizes: array = array('I')
+        self._live: bytearray = bytearray()
+        self._arena: bytearray = bytearray()
+        self._dead: int = 0
+        self._head: int = 0
+        self._pending: dict[int, MessageModel] = {}
+        self._pending_floor: float = float('inf')
+
+    def __len__(self) -> int:
+        return len(self._ids) - self._dead + len(self._pending)
+
+    def __iter__(self):
+        pending = sorted(self._pending)
+        next_pending = 0
+        for row in range(len(self._ids)):
+            if self._live[row]:
+                while next_pending < len(pending) and pending[next_pending] < self._ids[row]:
+                    yield self._pending[pending[next_pending]]
+                    next_pending += 1
+                yield self._model(row)
+        for message_id in pending[next_pending:]:
+            yield self._pending[message_id]
+
+    def get(self, message_id: int) -> MessageModel | None:
+        message = self._pending.get(message_id)
+        if message is None:
+            row = self._find(message_id)
+            if row is not None:
+                message = self._model(row)
+        return message
+
+    def insert(self, message: MessageModel):
+        self._stage(message)
+
+    def insert_many(self, messages: list[MessageModel]):
+        for message in messages:
+            self._pending[message.message_id] = message
+        if len(messages) > 0:
+            self._pending_floor = min(self._pending_floor, messages[0].message_id)
+            self._merge()
+
+    def replace(self, message: MessageModel):
+        if message.message_id not in self._pending:
+            self._kill(self._find(message.message_id))
+        self._stage(message)
+
+    def remove(self, message_id: int) -> MessageModel:
+        message = self._pending.pop(message_id, None)
+        if message is None:
+            row = self._find(message_id)
+            message = self._model(row)
+            self._kill(row)
+        return message
+
+    def first_id(self) -> int | None:
+        while self._head < len(self._ids) and not self._live[self._head]:
+            self._head += 1
+        base_first = self._ids[self._head] if self._head < len(self._ids) else None
+        if len(self._pending) == 0 or (base_first is not None and base_first < self._pending_floor):
+            return base_first
+        self._pending_floor = min(self._pending)
+        return self._pending_floor if base_first is None else min(base_first, self._pending_floor)
+
+    def freeze(self) -> 'ColumnarMessageStore':
+        frozen = ColumnarMessageStore()
+        frozen._set_columns([column[:] for column in self._columns()], self._live[:])
+        frozen._arena = bytes(self._arena)
+        frozen._pending = self._pending.copy()
+        return frozen
+
+    def _find(self, message_id: int) -> int | None:
+        # replaced messages leave dead rows with the same id in front of the live one
+        row = bisect.bisect_left(self._ids, message_id)
+        while row < len(self._ids) and self._ids[row] == message_id:
+            if self._live[row]:
+                return row
+            row += 1
+        return None
+
+    def _model(self, row: int) -> MessageModel:
+        offset = self._offsets[row]
+        content_end = offset + self._content_sizes[row]
+        end = content_end + self._attachment_sizes[row]
+        attachments = []
+        if end > content_end:
+            for line in self._arena[content_end:end].decode().split('\n'):
+                attachments.append((line[1:], line[0] == '1'))
+        return MessageModel(dict={'message_id': self._ids[row], 'channel_id': self._channels[row],
+                                  'user_id': self._users[row], 'content': self._arena[offset:content_end].decode(),
+                                  'sticker': self._stickers[row], 'attachments': attachments,
+                                  'reply_id': self._replies[row]})
+
+    def _stage(self, message: MessageModel):
+        self._pending[message.message_id] = message
+        self._pending_floor = min(self._pending_floor, message.message_id)
+        if len(self._pending) >= self._merge_threshold:
+            self._merge()
+
+    def _kill(self, row: int):
+        self._live[row] = 0
+        self._dead += 1
+        if self._dead >= self._min_compact_rows and self._dead * 2 > len(self._ids):
+            self._compact()
+
+    def _columns(self) -> list:
+        return [self._ids, self._channels, self._users, self._stickers, self._replies, self._offsets,
+                self._content_sizes, self._attachment_sizes]
+
+    def _merge(self):
+        pending = [self._pending[message_id] for message_id in sorted(self._pending)]
+        rows = []
+        for message in pending:
+            content = message.content.encode()
+            attachments = '\n'.join([('1' if is_spoiler else '0') + url
+                                     for url, is_spoiler in message.attachments]).encode()
+            rows.append((message.message_id, message.channel_id, message.user_id, message.sticker, message.reply_id,
+                         len(self._arena), len(content), len(attachments)))
+            self._arena += content
+            self._arena += attachments
+        columns = self._columns()
+        if len(self._ids) == 0 or pending[0].message_id > self._ids[-1]:
+            # live messages are always newer than the cache, so they can simply be appended
+            for row in rows:
+                for column, value in zip(columns, row):
+                    column.append(value)
+            self._live.extend(b'\x01' * len(rows))
+        else:
+            merged = [array(column.typecode) for column in columns]
+            live = bytearray()
+            start = 0
+            for row in rows:
+                position = bisect.bisect_left(self._ids, row[0], lo=start)
+                for merged_column, column, value in zip(merged, columns, row):
+                    merged_column.extend(column[start:position])
+                    merged_column.append(value)
+                live += self._live[start:position]
+                live.append(1)
+                start = position
+            for merged_column, column in zip(merged, columns):
+                merged_column.extend(column[start:])
+            live += self._live[start:]
+            self._set_columns(merged, live)
+        self._pending = {}
+        self._pending_floor = float('inf')
+
+    def _compact(self):
+        columns = self._columns()
+        merged = [array(column.typecode) for column in columns]
+        start = self._live.find(1)
+        while start >= 0:
+            end = self._live.find(0, start)
+            if end < 0:
+                end = len(self._live)
+            for merged_column, column in zip(merged, columns):
+                merged_column.extend(column[start:end])
+            start = self._live.find(1, end)
+        arena = bytearray()
+        offsets = merged[5]
+        for row in range(len(offsets)):
+            offset = offsets[row]
+            offsets[row] = len(arena)
+            arena += self._arena[offset:offset + merged[6][row] + merged[7][row]]
+        self._arena = arena
+        self._set_columns(merged, bytearray(b'\x01' * len(merged[0])))
+
+    def _set_columns(self, columns: list, live: bytearray):
+        (self._ids, self._channels, self._users, self._stickers, self._replies, self._offsets,
+         self._content_sizes, self._attachment_sizes) = columns
+        self._live = live
+        self._dead = live.count(0)
+        self._head = 0
+
+    def __sizeof__(self) -> int:
+        pending_size = self._pending.__sizeof__()
+        for model in self._pending.values():
+            pending_size += model.__sizeof__()
+        return (sum(column.buffer_info()[1] * column.itemsize for column in self._columns()) +
+                self._live.__sizeof__() + self._arena.__sizeof__() + pending_size)
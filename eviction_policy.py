@@ -0,0 +1,63 @@
+from abc import ABC, abstractmethod
+
+
+class EvictionPolicy(ABC):
+    """Decides which cached messages to drop once the cache is over one of its limits.
+
+    The cache reports every message that enters or leaves it through on_add and on_remove so a policy can keep its
+    own bookkeeping up to date incrementally, and asks victim for one message id at a time until the policy returns
+    None.
+    """
+    name: str = 'base'
+
+    def on_add(self, message_id: int, channel_id: int):
+        pass
+
+    def on_remove(self, message_id: int, channel_id: int):
+        pass
+
+    @abstractmethod
+    def victim(self, cache) -> int | None:
+        pass
+
+
+class OldestEvictionPolicy(EvictionPolicy):
+    """Keeps at most max_entries messages, dropping the oldest snowflakes first."""
+    name = 'oldest'
+
+    def __init__(self, max_entries: int):
+        self.max_entries: int = max_entries
+
+    def victim(self, cache) -> int | None:
+        return cache.oldest_id() if cache.len() > self.max_entries else None
+
+
+class ChannelQuotaEvictionPolicy(EvictionPolicy):
+    """Keeps at most quota messages per channel, so one busy channel cannot push every other channel out."""
+    name = 'channel_quota'
+
+    def __init__(self, quota: int):
+        self.quota: int = quota
+        self._over_quota: set[int] = set()
+
+    def on_add(self, message_id: int, channel_id: int):
+        self._over_quota.add(channel_id)
+
+    def victim(self, cache) -> int | None:
+        while len(self._over_quota) > 0:
+            channel_id = next(iter(self._over_quota))
+            if cache.channel_len(channel_id) > self.quota:
+                return cache.oldest_id(channel_id)
+            self._over_quota.discard(channel_id)
+        return None
+
+
+class ByteBudgetEvictionPolicy(EvictionPolicy):
+    """Keeps the approximate footprint of the cached models under max_bytes, dropping the oldest snowflakes first."""
+    name = 'byte_budget'
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes: int = max_bytes
+
+    def victim(self, cache) -> int | None:
+        return cache.oldest_id() if cache.size() > self.max_bytes else None
@@ -0,0 +1,35 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from yt_dlp import YoutubeDL
+
+
+class ExtractionService:
+    def __init__(self, ytdl_options: dict, max_workers: int, timeout: float):
+        self.ytdl_options: dict = ytdl_options
+        self.timeout: float = timeout
+        self.queued: int = 0
+        self._slots: asyncio.Semaphore = asyncio.Semaphore(max_workers)
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers,
+                                                                thread_name_prefix='yt-dlp')
+
+    def is_busy(self) -> bool:
+        return self._slots.locked()
+
+    async def extract(self, url: str) -> dict:
+        self.queued += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.queued -= 1
+        future = asyncio.get_running_loop().run_in_executor(self._executor, self._extract, url)
+        # yt-dlp cannot be interrupted, so a timed out extraction keeps its slot until its thread returns
+        future.add_done_callback(lambda _: self._slots.release())
+        return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _extract(self, url: str) -> dict:
+        with YoutubeDL(self.ytdl_options) as ytdl:
+            return ytdl.extract_info(url=url, download=False, process=True)
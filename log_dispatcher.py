@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+import traceback
+from collections import deque
+from typing import Awaitable, Callable
+
+import discord
+
+
+class LogDispatcher:
+    """Sends log embeds from a background task, packing queued embeds into as few messages as possible.
+
+    Event handlers call send and return at once. The worker takes whatever is queued and packs it into one message
+    up to Discord's limits (10 embeds, 6000 embed characters, 10 files and the guild's upload size per message), uploads
+    the files in the same request, and adds the reaction without waiting for it. A quiet channel gets every embed right
+    away; a burst of deletions is sent ten at a time. If Discord rejects a message with files, its embeds are sent again
+    without them and each log's files follow in a message of their own, so a failed upload never loses the embeds.
+    """
+    max_embeds: int = 10
+    max_embed_chars: int = 6000
+    max_files: int = 10
+
+    def __init__(self, reaction: str, on_error: Callable[[str], Awaitable]):
+        self.reaction: str = reaction
+        self.messages_sent: int = 0
+        self.embeds_sent: int = 0
+        self._on_error: Callable[[str], Awaitable] = on_error
+        self._queue: deque = deque()
+        self._ready: asyncio.Event = asyncio.Event()
+        self._channel: discord.TextChannel | None = None
+        self._max_upload_bytes: int = 0
+        self._worker: asyncio.Task | None = None
+        self._reactions: set[asyncio.Task] = set()
+        self._latency_total: float = 0
+        self._max_latency: float = 0
+
+    def start(self, channel: discord.TextChannel):
+        self._channel = channel
+        self._max_upload_bytes = channel.guild.filesize_limit
+        self._worker = asyncio.create_task(self._run())
+
+    def send(self, embed: discord.Embed, files: list[discord.File] = None):
+        files = files if files is not None else []
+        self._queue.append((embed, files, time.perf_counter(), sum(self._file_size(file) for file in files)))
+        self._ready.set()
+
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def average_latency(self) -> float:
+        """Mean seconds from send to the message being posted."""
+        return self._latency_total / self.embeds_sent if self.embeds_sent > 0 else 0
+
+    def max_latency(self) -> float:
+        return self._max_latency
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            while len(self._queue) > 0:
+                try:
+                    await self._post(self._take_batch())
+                except Exception:
+                    await self._on_error(traceback.format_exc(limit=None))
+            self._ready.clear()
+
+    def _take_batch(self) -> list[tuple[discord.Embed, list[discord.File], float, int]]:
+        batch = [self._queue.popleft()]
+        num_chars = len(batch[0][0])
+        num_files = len(batch[0][1])
+        num_bytes = batch[0][3]
+        while len(batch) < self.max_embeds and len(self._queue) > 0:
+            embed, files, _, size = self._queue[0]
+            if (num_chars + len(embed) > self.max_embed_chars or num_files + len(files) > self.max_files or
+                    num_bytes + size > self._max_upload_bytes):
+                break
+            batch.append(self._queue.popleft())
+            num_chars += len(embed)
+            num_files += len(files)
+            num_bytes += size
+        return batch
+
+    async def _post(self, batch: list[tuple[discord.Embed, list[discord.File], float, int]]):
+        embeds = [embed for embed, _, _, _ in batch]
+        files = [file for _, entry_files, _, _ in batch for file in entry_files]
+        if len(files) == 0:
+            self._posted(batch, await self._channel.send(embeds=embeds))
+            return
+        try:
+            self._posted(batch, await self._channel.send(embeds=embeds, files=files))
+            return
+        except discord.HTTPException:
+            await self._on_error(traceback.format_exc(limit=None))
+        self._posted(batch, await self._channel.send(embeds=embeds))
+        for _, entry_files, _, _ in batch:
+            if len(entry_files) == 0:
+                continue
+            for file in entry_files:
+                file.reset()
+            try:
+                await self._channel.send(files=entry_files)
+            except discord.HTTPException:
+                await self._on_error(traceback.format_exc(limit=None))
+
+    def _posted(self, batch: list[tuple[discord.Embed, list[discord.File], float, int]], log: discord.Message):
+        posted = time.perf_counter()
+        self.messages_sent += 1
+        self.embeds_sent += len(batch)
+        for _, _, queued, _ in batch:
+            self._latency_total += posted - queued
+            self._max_latency = max(self._max_latency, posted - queued)
+        reaction = asyncio.create_task(log.add_reaction(self.reaction))
+        self._reactions.add(reaction)
+        reaction.add_done_callback(self._reactions.discard)
+
+    @staticmethod
+    def _file_size(file: discord.File) -> int:
+        position = file.fp.tell()
+        size = file.fp.seek(0, os.SEEK_END)
+        file.fp.seek(position)
+        return size
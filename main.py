@@ -1,10 +1,11 @@
 # Celestia Bot
 # Version 1.3.0
 
+import asyncio
 import os
 import time
 import traceback
-from collections import defaultdict, Counter
+from collections import defaultdict, deque, Counter
 
 import discord
 from discord.ext import tasks, commands
@@ -18,8 +19,19 @@ import io
 
 from dotenv import load_dotenv
 
-from message_model import MessageModel
+from message_model import MessageModel, jump_url, update_to_dict
 from message_cache import MessageCache
+from message_store import MessageStore, IndexedMessageStore
+from columnar_message_store import ColumnarMessageStore
+from eviction_policy import EvictionPolicy, ChannelQuotaEvictionPolicy, ByteBudgetEvictionPolicy
+from cache_snapshot import (SnapshotError, open_snapshot, read_snapshot, remove_snapshots, snapshot_generation,
+                            snapshot_generations, snapshot_path, write_snapshot)
+from snapshot_message_store import SnapshotMessageStore
+from cache_wal import CacheWal, replay_wal
+from sqlite_spill import SqliteSpill
+from log_dispatcher import LogDispatcher
+from attachment_archive import AttachmentArchive
+from sticker_cache import StickerCache
 from music_cog import MusicBot
 
 
@@ -38,18 +50,54 @@ celestia_id: int = int(config['celestia_id'])
 server: int = int(config['server'])
 admin_role = int(config['admin'])
 max_messages: int = int(config['max_messages'])
+channel_quota: int = int(config['channel_quota'])
+max_cache_bytes: int = int(config['max_cache_bytes'])
+cache_backend: str = config['cache_backend']
 backlog_length: int = int(config['backlog_length'])
 log_channel: int = int(config['log_channel'])
 dev_channel: int = int(config['dev_channel'])
 log_history: int = int(config['log_history'])
+attachment_timeout_seconds: float = float(config['attachment_timeout_seconds'])
+max_attachment_bytes: int = int(config['max_attachment_bytes'])
+max_attachment_downloads: int = int(config['max_attachment_downloads'])
+max_attachment_prefetches: int = int(config['max_attachment_prefetches'])
+attachment_prefetch_wait_seconds: float = float(config['attachment_prefetch_wait_seconds'])
+attachment_archive_bytes: int = int(config['attachment_archive_bytes'])
+sticker_cache_size: int = int(config['sticker_cache_size'])
+sticker_cache_ttl_seconds: float = float(config['sticker_cache_ttl_seconds'])
 ignored_categories: list[int] = config['ignored_categories']
 dm_probability: float = float(config['dm_probability'])
 read_cache_file: bool = config['read_cache_file']
+wal_flush_seconds: float = float(config['wal_flush_seconds'])
+backfill_concurrency: int = int(config['backfill_concurrency'])
+spill_path: str = config['spill_path']
+spill_retention_days: int = int(config['spill_retention_days'])
 music_channel: int = int(config['music_channel'])
 music_cmd_channel: int = int(config['music_cmd_channel'])
 
+
+def get_eviction_policies() -> list[EvictionPolicy]:
+    policies: list[EvictionPolicy] = []
+    if channel_quota > 0:
+        policies.append(ChannelQuotaEvictionPolicy(quota=channel_quota))
+    if max_cache_bytes > 0:
+        policies.append(ByteBudgetEvictionPolicy(max_bytes=max_cache_bytes))
+    return policies
+
+
+def create_message_store() -> MessageStore:
+    return ColumnarMessageStore() if cache_backend == 'columnar' else IndexedMessageStore()
+
+
 # cache
-message_cache: MessageCache = MessageCache(max_cache_size=max_messages)
+cache_directory: str = '.cache'
+legacy_snapshot_path: str = '.cache/cache.bin'
+legacy_cache_path: str = '.cache/cache.txt'
+cache_wal: CacheWal | None = None
+backfill_batch_size: int = 1000
+message_spill: SqliteSpill | None = None
+message_cache: MessageCache = MessageCache(max_cache_size=max_messages, policies=get_eviction_policies(),
+                                           store=create_message_store())
 i: int = 0
 
 # birthday
@@ -71,7 +119,20 @@ celestia_caught: int = 1018593299440869487
 pdt = datetime.timezone(-datetime.timedelta(hours=7))
 pst = datetime.timezone(-datetime.timedelta(hours=8))
 is_setting_up = True
+# channels whose backfill is done, and the edit/delete events of the others, held until their backfill is
+ready_channels: set[int] = set()
+startup_events: dict[int, deque] = defaultdict(deque)
 start_time: datetime.datetime | None = None
+http_session: aiohttp.ClientSession | None = None
+# log downloads and archive prefetches take separate slots, so speculative prefetches never queue ahead of a log
+attachment_downloads: asyncio.Semaphore = asyncio.Semaphore(max_attachment_downloads)
+attachment_prefetches: asyncio.Semaphore = asyncio.Semaphore(max_attachment_prefetches)
+attachment_archive: AttachmentArchive | None = (
+    AttachmentArchive('.cache/attachments', max_bytes=attachment_archive_bytes,
+                      download=lambda url: get_image_bytes(url, slots=attachment_prefetches),
+                      max_wait=attachment_prefetch_wait_seconds) if attachment_archive_bytes > 0 else None)
+sticker_cache: StickerCache = StickerCache(max_entries=sticker_cache_size, ttl=sticker_cache_ttl_seconds)
+log_dispatcher: LogDispatcher = LogDispatcher(reaction='✉', on_error=lambda error: notify_error(error))
 logging.basicConfig(filename='celestia-logs.txt', encoding='utf-8', level=logging.INFO, filemode='w')
 
 # bot setup
@@ -85,34 +146,23 @@ async def create_delete_log_embed(message: MessageModel) -> tuple[discord.Embed,
     author = bot.get_user(message.user_id)
     channel = bot.get_channel(message.channel_id)
 
-    message_iterator = channel.history(limit=log_history, before=discord.Object(message.message_id), oldest_first=False)
     embed_color = discord.Color.red()
     embed = discord.Embed(
         title='Message deleted',
         description=f'**{author.name}\'s message was deleted in <#{channel.id}>**' +
-                    (f'\nReplied to [this message]({message.reply_url})' if message.reply_url != '' else ''),
+                    (f'\nReplied to [this message]({message.get_reply_url(server)})' if message.reply_id != 0 else ''),
         color=embed_color)
     embed.set_author(name=f'{author.global_name} ({author.display_name})',
                      icon_url=author.display_avatar.url)
     first_message_url = None
     files = []
 
-    while True:
-        try:
-            previous_message: discord.Message = await anext(message_iterator)
-            if previous_message.type != discord.MessageType.default:
-                continue
-            num_fields = insert_embed_text(embed=embed, name=f'**{previous_message.author.name}**',
-                                           value=get_message_content(previous_message),
-                                           index=0)
-            if len(previous_message.attachments) > 0:
-                embed.insert_field_at(index=num_fields, name='Attachments',
-                                      value='\n'.join([attachment.url for attachment in previous_message.attachments]),
-                                      inline=False)
-
-            first_message_url = previous_message.jump_url
-        except StopAsyncIteration:
-            break
+    for author_name, content, attachment_urls, message_url in await get_log_context(message):
+        num_fields = insert_embed_text(embed=embed, name=f'**{author_name}**', value=content, index=0)
+        if len(attachment_urls) > 0:
+            embed.insert_field_at(index=num_fields, name='Attachments', value='\n'.join(attachment_urls),
+                                  inline=False)
+        first_message_url = message_url
     if first_message_url is not None:
         embed.url = first_message_url
     insert_embed_text(embed=embed, name=f'**Deleted message - {author.name}**',
@@ -120,15 +170,35 @@ async def create_delete_log_embed(message: MessageModel) -> tuple[discord.Embed,
                       index=len(embed.fields))
     if len(message.attachments) > 0:
         embed.add_field(name='Attachments', value='\n'.join([attachment[0] for attachment in message.attachments]), inline=False)
-        for index in range(len(message.attachments)):
-            ext = MessageModel.is_image(message.attachments[index][0])
-            if ext is not None:
-                files.append(discord.File(await get_image_bytes(message.attachments[index][0]),
-                                          f'Attachment {index + 1}{ext}', spoiler=message.attachments[index][1]))
+        files = await get_attachment_files(message.attachments)
     embed.set_footer(text=f'Deleted at {datetime.datetime.now(get_timezone()).isoformat(sep=" ", timespec="seconds")}')
     return embed, files
 
 
+async def get_log_context(message: MessageModel) -> list[tuple[str, str, list[str], str]]:
+    """Returns the log_history messages before message in its channel, newest first, as (author name, content,
+    attachment urls, jump url). They come from the cache, and from the channel history only when the cache holds
+    fewer than log_history of them."""
+    context = []
+    cached_messages = message_cache.get_previous(message.channel_id, message.message_id, log_history)
+    if len(cached_messages) == log_history:
+        for previous_message in cached_messages:
+            author = bot.get_user(previous_message.user_id)
+            context.append((author.name if author is not None else str(previous_message.user_id),
+                            await get_message_model_content(previous_message),
+                            [attachment[0] for attachment in previous_message.attachments],
+                            jump_url(server, previous_message.channel_id, previous_message.message_id)))
+        return context
+    channel = bot.get_channel(message.channel_id)
+    async for previous_message in channel.history(limit=log_history, before=discord.Object(message.message_id),
+                                                  oldest_first=False):
+        if previous_message.type != discord.MessageType.default:
+            continue
+        context.append((previous_message.author.name, get_message_content(previous_message),
+                        [attachment.url for attachment in previous_message.attachments], previous_message.jump_url))
+    return context
+
+
 async def create_edit_log_embed(before: MessageModel, after: MessageModel) -> tuple[discord.Embed, list[discord.File]]:
     author = bot.get_user(after.user_id)
     channel = bot.get_channel(after.channel_id)
@@ -138,20 +208,16 @@ async def create_edit_log_embed(before: MessageModel, after: MessageModel) -> tu
     embed = discord.Embed(
         title='Message edited',
         description=f'**{author.name} edited a message in <#{channel.id}>**' +
-                    (f'\nReplied to [this message]({before.reply_url})' if before.reply_url != '' else ''),
+                    (f'\nReplied to [this message]({before.get_reply_url(server)})' if before.reply_id != 0 else ''),
         color=embed_color)
     embed.set_author(name=f'{author.global_name} ({author.display_name})',
                      icon_url=author.display_avatar.url)
-    embed.url = (await channel.get_partial_message(after.message_id).fetch()).jump_url
+    embed.url = jump_url(server, after.channel_id, after.message_id)
     insert_embed_text(embed=embed, name=f'**Before**',
                       value=await get_message_model_content(before), index=len(embed.fields))
     if len(before.attachments) > 0:
         embed.add_field(name='Attachments', value='\n'.join([attachment[0] for attachment in before.attachments]), inline=False)
-        for index in range(len(before.attachments)):
-            ext = MessageModel.is_image(before.attachments[index][0])
-            if ext is not None:
-                files.append(discord.File(await get_image_bytes(before.attachments[index][0]),
-                                          f'Attachment {index + 1}{ext}', spoiler=before.attachments[index][1]))
+        files = await get_attachment_files(before.attachments)
     insert_embed_text(embed=embed, name=f'**After**',
                       value=await get_message_model_content(after), index=len(embed.fields))
     if len(after.attachments) > 0:
@@ -185,7 +251,15 @@ def insert_embed_text(embed: discord.Embed, name: str, value: str, index: int) -
 
 
 async def get_message_model_content(message: MessageModel) -> str:
-    return message.content + ('' if message.sticker == 0 else f'\n:{await bot.fetch_sticker(message.sticker)}:')
+    return message.content + ('' if message.sticker == 0 else f'\n:{await get_sticker_name(message.sticker)}:')
+
+
+async def get_sticker_name(sticker_id: int) -> str:
+    name = sticker_cache.get(sticker_id)
+    if name is None:
+        name = (await bot.fetch_sticker(sticker_id)).name
+        sticker_cache.put(sticker_id, name)
+    return name
 
 
 def get_message_content(message: discord.Message) -> str:
@@ -194,41 +268,114 @@ def get_message_content(message: discord.Message) -> str:
 
 
 async def populate_cache():
-    global is_setting_up, message_cache
+    global is_setting_up, message_cache, cache_wal, message_spill
+    wal_generations = CacheWal.generations(cache_directory)
+    snapshot_wal_generation = 0
     if read_cache_file:
         try:
             read_cache_time: float = get_unix_time(datetime.datetime.now())
-            cache_file = open(".cache/cache.txt")
-            cache_object = json.load(cache_file)
-            message_cache = MessageCache(max_cache_size=max_messages, cache=cache_object)
+            # each snapshot gets its own file, so a new one never replaces the file the cache still maps
+            generations = snapshot_generations(cache_directory)
+            cache_snapshot_path = (snapshot_path(cache_directory, generations[-1]) if len(generations) > 0
+                                   else legacy_snapshot_path)
+            if os.path.exists(cache_snapshot_path):
+                snapshot_wal_generation = snapshot_generation(cache_snapshot_path)
+                snapshot = open_snapshot(cache_snapshot_path)
+                if snapshot is not None:
+                    # messages stay in the mapped file until an edit or delete touches them
+                    message_cache = MessageCache(max_cache_size=max_messages, policies=get_eviction_policies(),
+                                                 store=SnapshotMessageStore(snapshot, create_message_store()))
+                else:  # snapshots written before they were indexed
+                    message_cache = MessageCache(max_cache_size=max_messages,
+                                                 cache=read_snapshot(cache_snapshot_path),
+                                                 policies=get_eviction_policies(), store=create_message_store())
+            else:  # caches written before snapshots were introduced
+                cache_file = open(legacy_cache_path)
+                cache_object = json.load(cache_file)
+                message_cache = MessageCache(max_cache_size=max_messages, cache=cache_object,
+                                             policies=get_eviction_policies(), store=create_message_store())
+            num_records = replay_wal(cache_directory, snapshot_wal_generation, message_cache)
             print_to_bot_logs(f'Loaded cache file in '
                               f'{round(get_unix_time(datetime.datetime.now()) - read_cache_time, 3)}s')
-        except json.decoder.JSONDecodeError:
+            print_to_bot_logs(f'Replayed {num_records} write-ahead log records')
+        except (json.decoder.JSONDecodeError, SnapshotError):
             print_to_bot_logs("Failed to read cache file")
+    cache_wal = CacheWal(cache_directory, generation=max(wal_generations + [snapshot_wal_generation]) + 1)
+    message_cache.set_journal(cache_wal)
+    if spill_path != '':
+        message_spill = SqliteSpill(spill_path, retention_days=spill_retention_days)
+        message_cache.set_spill(message_spill)
     guild: discord.Guild = bot.get_guild(server)
     if guild is not None:
-        channels = guild.channels
-        for channel in channels:
-            if channel.type == discord.ChannelType.text and channel.category_id not in ignored_categories:
-                time_start = max([datetime.datetime.now(get_timezone()) - datetime.timedelta(days=backlog_length),
-                                  message_cache.get_max_time(channel_id=channel.id, tzinfo=get_timezone())])
-                print_to_bot_logs(f'Caching channel {channel.name}')
-                num_messages = 0
-                message_iterator = channel.history(limit=None, after=time_start)
-                while True:
-                    try:
-                        next_message: discord.Message = await anext(message_iterator)
-                        if not next_message.author.bot and is_normal_message(next_message.type):
-                            message_cache.add_message_model(MessageModel(next_message), append=False)
-                            num_messages += 1
-                    except StopAsyncIteration:
-                        break
-                    except discord.errors.Forbidden:
-                        break
-                print_to_bot_logs(f'Found {num_messages} to cache')
+        for sticker in guild.stickers:
+            sticker_cache.put(sticker.id, sticker.name)
+        channels = [channel for channel in guild.channels
+                    if channel.type == discord.ChannelType.text and channel.category_id not in ignored_categories]
+        # most recently active channels first, so they are cached before the quiet ones
+        channels.sort(key=lambda channel: channel.last_message_id or 0, reverse=True)
+        semaphore = asyncio.Semaphore(backfill_concurrency)
+        await asyncio.gather(*[backfill_channel(channel, semaphore) for channel in channels])
+    # channels that were not backfilled, such as ignored categories, still get their events handled
+    while len(startup_events) > 0:
+        await mark_channel_ready(next(iter(startup_events)))
     is_setting_up = False
 
 
+async def backfill_channel(channel: discord.TextChannel, semaphore: asyncio.Semaphore):
+    """Caches the recent history of one channel. Discord rate limits are waited out by the HTTP client, and
+    semaphore bounds how many channels are fetched at once."""
+    try:
+        async with semaphore:
+            await cache_channel_history(channel)
+    finally:
+        await mark_channel_ready(channel.id)
+
+
+async def cache_channel_history(channel: discord.TextChannel):
+    time_start = max([datetime.datetime.now(get_timezone()) - datetime.timedelta(days=backlog_length),
+                      message_cache.get_max_time(channel_id=channel.id, tzinfo=get_timezone())])
+    print_to_bot_logs(f'Caching channel {channel.name}')
+    channel_start_time: float = get_unix_time(datetime.datetime.now())
+    num_messages = 0
+    # history after a date comes oldest first, so every batch is already sorted for bulk_add
+    batch: list[MessageModel] = []
+    message_iterator = channel.history(limit=None, after=time_start)
+    while True:
+        try:
+            next_message: discord.Message = await anext(message_iterator)
+            if not next_message.author.bot and is_normal_message(next_message.type):
+                batch.append(MessageModel(next_message))
+                num_messages += 1
+                if len(batch) >= backfill_batch_size:
+                    message_cache.bulk_add(batch)
+                    batch = []
+        except StopAsyncIteration:
+            break
+        except discord.errors.Forbidden:
+            break
+    message_cache.bulk_add(batch)
+    channel_time = get_unix_time(datetime.datetime.now()) - channel_start_time
+    print_to_bot_logs(f'Found {num_messages} to cache in {channel.name} in {round(channel_time, 3)}s '
+                      f'({round(num_messages / channel_time, 1) if channel_time > 0 else 0} messages/s)')
+
+
+async def mark_channel_ready(channel_id: int):
+    """Handles the events held for a channel during startup, oldest first, then lets later ones through directly."""
+    events = startup_events[channel_id]
+    while len(events) > 0:
+        payload = events.popleft()
+        if isinstance(payload, discord.RawMessageUpdateEvent):
+            await handle_message_edit(payload)
+        else:
+            await handle_message_delete(payload)
+    ready_channels.add(channel_id)
+    del startup_events[channel_id]
+
+
+def is_channel_ready(channel_id: int) -> bool:
+    return not is_setting_up or channel_id in ready_channels
+
+
 async def notify_error(error: str, message_model: MessageModel = None):
     print(error)
     message_str = f'{f"From message id {message_model.message_id}"}' if message_model is not None else ''
@@ -250,13 +397,48 @@ async def send_dm_message(user_id: int):
         await user.send(content='https://media.discordapp.net/stickers/1018593299440869487.webp?size=160')
 
 
-async def get_image_bytes(proxy_url: str) -> io.BytesIO | None:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(proxy_url) as resp:
-            if resp.status != 200:
-                return None
-            data = io.BytesIO(await resp.read())
-            return data
+def get_http_session() -> aiohttp.ClientSession:
+    """Returns the bot's shared HTTP session, so attachment downloads reuse pooled connections."""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=attachment_timeout_seconds),
+                                             connector=aiohttp.TCPConnector(
+                                                 limit=max_attachment_downloads + max_attachment_prefetches))
+    return http_session
+
+
+async def get_image_bytes(proxy_url: str, slots: asyncio.Semaphore = None) -> io.BytesIO | None:
+    """Downloads an attachment, or returns None if it fails, times out, or is larger than max_attachment_bytes.
+    The download waits for one of slots, attachment_downloads by default."""
+    try:
+        async with slots if slots is not None else attachment_downloads:
+            async with get_http_session().get(proxy_url) as resp:
+                if resp.status != 200 or (resp.content_length or 0) > max_attachment_bytes:
+                    return None
+                data = io.BytesIO()
+                async for chunk in resp.content.iter_chunked(1 << 16):
+                    data.write(chunk)
+                    if data.tell() > max_attachment_bytes:
+                        return None
+                data.seek(0)
+                return data
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def get_attachment_bytes(proxy_url: str) -> io.BytesIO | None:
+    """Returns an attachment from the archive when it was prefetched, and downloads it otherwise."""
+    data = await attachment_archive.read(proxy_url) if attachment_archive is not None else None
+    return data if data is not None else await get_image_bytes(proxy_url)
+
+
+async def get_attachment_files(attachments: list[tuple[str, bool]]) -> list[discord.File]:
+    """Downloads the image attachments of a message concurrently, skipping any that could not be downloaded."""
+    images = [(index, url, is_spoiler, MessageModel.is_image(url))
+              for index, (url, is_spoiler) in enumerate(attachments) if MessageModel.is_image(url) is not None]
+    downloads = await asyncio.gather(*[get_attachment_bytes(url) for _, url, _, _ in images])
+    return [discord.File(data, f'Attachment {index + 1}{ext}', spoiler=is_spoiler)
+            for (index, _, is_spoiler, ext), data in zip(images, downloads) if data is not None]
 
 
 def print_to_bot_logs(log: str):
@@ -266,12 +448,30 @@ def print_to_bot_logs(log: str):
 
 def get_metrics() -> str:
     length = message_cache.len()
-    size = message_cache.__sizeof__()
-    ret_str = (f'Cache length: {length} entries' + '\n' + f'Cache size: {size} bytes' + '\n'
-               f'Average entry size: {round(size / length, 2) if length > 0 else 0} bytes')
+    size = message_cache.size()
+    evictions = ', '.join([f'{name} {count}' for name, count in message_cache.get_eviction_counts().items()])
+    ret_str = (f'Cache length: {length} entries in {message_cache.channel_count()} channels' + '\n'
+               f'Cache size: {size} bytes' + '\n'
+               f'Average entry size: {round(size / length, 2) if length > 0 else 0} bytes' + '\n'
+               f'Evictions: {evictions}' + '\n'
+               f'Log queue: {log_dispatcher.depth()} waiting, {log_dispatcher.embeds_sent} embeds in '
+               f'{log_dispatcher.messages_sent} messages, latency {round(log_dispatcher.average_latency(), 3)}s '
+               f'average, {round(log_dispatcher.max_latency(), 3)}s max')
+    if message_spill is not None:
+        ret_str += '\n' + f'Spilled to disk: {message_spill.rows_written} writes'
+    if attachment_archive is not None:
+        ret_str += '\n' + (f'Attachment archive: {len(attachment_archive)} files, {attachment_archive.size()} bytes, '
+                           f'{attachment_archive.hits} hits, {attachment_archive.misses} misses')
+    ret_str += '\n' + (f'Sticker names: {len(sticker_cache)} cached, {sticker_cache.hits} hits, '
+                       f'{sticker_cache.misses} misses')
     return ret_str
 
 
+def get_size_histogram() -> str:
+    histogram = message_cache.get_size_histogram()
+    return 'Entry sizes: ' + ', '.join([f'<={bound}B {count}' for bound, count in histogram.items()])
+
+
 def get_unix_time(date_time: datetime.datetime) -> float:
     return datetime.datetime.timestamp(date_time)
 
@@ -288,48 +488,63 @@ def is_normal_message(message_type: discord.MessageType) -> bool:
     return message_type == discord.MessageType.default or message_type == discord.MessageType.reply
 
 
-def to_json(obj):
-    return json.dumps(obj, default=lambda o: o.__dict__, indent=4)
-
-
 @bot.event
 async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    if is_channel_ready(payload.channel_id):
+        await handle_message_edit(payload)
+    else:
+        startup_events[payload.channel_id].append(payload)
+
+
+async def handle_message_edit(payload: discord.RawMessageUpdateEvent):
     after = None
     try:
-        if not is_setting_up:
-            after_message = await bot.get_channel(payload.channel_id).get_partial_message(payload.message_id).fetch()
-            if after_message.author.bot or after_message.guild.id != server:
-                return
-            after = MessageModel(after_message)
-            before = message_cache.get_message_model(message=after, update=True)
-            if before is not None and not before.total_eq(after):
-                embed, attachments = await create_edit_log_embed(before=before, after=after)
-                log = await bot.get_channel(log_channel).send(embed=embed)
-                await log.add_reaction('✉')
-                if len(attachments) > 0:
-                    await bot.get_channel(log_channel).send(files=attachments)
-                await send_dm_message(after.user_id)
+        after = await get_edited_message(payload)
+        if after is None:
+            return
+        before = await message_cache.fetch_message_model(message=after, update=True)
+        if before is not None and not before.total_eq(after):
+            embed, attachments = await create_edit_log_embed(before=before, after=after)
+            log_dispatcher.send(embed, attachments)
+            await send_dm_message(after.user_id)
     except:
         await notify_error(traceback.format_exc(limit=None), message_model=after)
 
 
+async def get_edited_message(payload: discord.RawMessageUpdateEvent) -> MessageModel | None:
+    """Returns the edited message as a model, or None if it should not be logged. The model is built from the event
+    itself, and the message is only fetched when the event leaves out some of its fields."""
+    model_dict = update_to_dict(payload.data)
+    if model_dict is not None:
+        if payload.data['author'].get('bot', False) or payload.guild_id != server:
+            return None
+        return MessageModel(dict=model_dict)
+    after_message = await bot.get_channel(payload.channel_id).get_partial_message(payload.message_id).fetch()
+    if after_message.author.bot or after_message.guild.id != server:
+        return None
+    return MessageModel(after_message)
+
+
 @bot.event
 async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    if is_channel_ready(payload.channel_id):
+        await handle_message_delete(payload)
+    else:
+        startup_events[payload.channel_id].append(payload)
+
+
+async def handle_message_delete(payload: discord.RawMessageDeleteEvent):
     message = None
     try:
-        if not is_setting_up:
-            if payload.cached_message is not None:
-                if payload.cached_message.author.bot or payload.cached_message.guild.id != server:
-                    return
-            message = message_cache.get_message_model(MessageModel(message=payload.cached_message, payload=payload),
-                                                      delete=True)
-            if message is not None:
-                embed, attachments = await create_delete_log_embed(message=message)
-                log = await bot.get_channel(log_channel).send(embed=embed)
-                await log.add_reaction('✉')
-                if len(attachments) > 0:
-                    await bot.get_channel(log_channel).send(files=attachments)
-                await send_dm_message(message.user_id)
+        if payload.cached_message is not None:
+            if payload.cached_message.author.bot or payload.cached_message.guild.id != server:
+                return
+        message = await message_cache.fetch_message_model(
+            MessageModel(message=payload.cached_message, payload=payload), delete=True)
+        if message is not None:
+            embed, attachments = await create_delete_log_embed(message=message)
+            log_dispatcher.send(embed, attachments)
+            await send_dm_message(message.user_id)
     except:
         await notify_error(traceback.format_exc(limit=None), message_model=message)
 
@@ -341,7 +556,14 @@ async def on_message(message: discord.Message):
         if ((not message.author.bot) and message.guild.id == server
                 and message.channel.category_id not in ignored_categories
                 and is_normal_message(message.type)):
-            message_cache.add_message_model(MessageModel(message=message))
+            message_model = MessageModel(message=message)
+            message_cache.add_message_model(message_model)
+            for sticker in message.stickers:
+                sticker_cache.put(sticker.id, sticker.name)
+            if attachment_archive is not None:
+                for url, _ in message_model.attachments:
+                    if MessageModel.is_image(url) is not None:
+                        attachment_archive.prefetch(url)
             i = i + 1
             if i % 100 == 0:
                 print_to_bot_logs(get_metrics())
@@ -372,13 +594,47 @@ async def on_reaction_add(reaction: discord.Reaction, user: discord.User):
         await notify_error(traceback.format_exc(limit=None), message_model=MessageModel(reaction.message))
 
 
+@tasks.loop(seconds=wal_flush_seconds)
+async def flush_wal():
+    await asyncio.to_thread(cache_wal.flush)
+
+
+@flush_wal.after_loop
+async def close_wal():
+    # runs once the loop is cancelled, when the bot shuts down
+    await asyncio.to_thread(cache_wal.close)
+
+
+@tasks.loop(seconds=wal_flush_seconds)
+async def flush_spill():
+    if message_spill is not None:
+        await message_spill.flush()
+
+
+@flush_spill.after_loop
+async def close_spill():
+    if message_spill is not None:
+        await message_spill.flush()
+        message_spill.close()
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+
+
 @tasks.loop(hours=1)
 async def print_cache():
     print_cache_time: float = get_unix_time(datetime.datetime.now())
-    cache_file = open(".cache/cache.txt", "w")
-    cache_file.write(to_json(message_cache.get_cache()))
-    cache_file.close()
-    print_to_bot_logs(f'Wrote to cache at {datetime.datetime.now(tz=get_timezone()).isoformat()}, writing time was '
+    # rotating and copying the cache happen together on the loop, so the snapshot holds every older generation
+    wal_generation = cache_wal.rotate()
+    view = message_cache.view()
+    try:
+        num_messages = await asyncio.to_thread(write_snapshot, snapshot_path(cache_directory, wal_generation), view,
+                                               wal_generation)
+    finally:
+        view.close()
+    await asyncio.to_thread(cache_wal.checkpoint, wal_generation)
+    await asyncio.to_thread(remove_snapshots, cache_directory, wal_generation)
+    print_to_bot_logs(f'Wrote {num_messages} messages to cache at '
+                      f'{datetime.datetime.now(tz=get_timezone()).isoformat()}, writing time was '
                       f'{round(get_unix_time(datetime.datetime.now()) - print_cache_time, 3)}s')
 
 
@@ -445,7 +701,8 @@ async def get_info(ctx: commands.Context):
     if ctx.message.channel.id == log_channel and ctx.author.get_role(admin_role) is not None:
         content = (f'```Running version {version}' + '\n' + f'Celestia has been running for '
                    f'{str(datetime.datetime.now(get_timezone()) - start_time).split(".")[0]}' + '\n'
-                   f'{get_metrics()}```')
+                   f'{get_metrics()}' + '\n'
+                   f'{get_size_histogram()}```')
         log = await bot.get_channel(log_channel).send(content=content)
         await log.add_reaction('✉')
 
@@ -463,6 +720,7 @@ async def raise_error(ctx: commands.Context):
 async def on_ready():
     global start_time
     await bot.add_cog(MusicBot(bot, bot.get_channel(music_channel), bot.get_channel(music_cmd_channel)))
+    log_dispatcher.start(bot.get_channel(log_channel))
     try:
         print_to_bot_logs('We have logged in as {0.user}'.format(bot) + '\n')
         start_time = datetime.datetime.now(get_timezone())
@@ -472,6 +730,8 @@ async def on_ready():
         caching_time = round(get_unix_time(datetime.datetime.now()) - populate_time, 3)
         print_to_bot_logs(f'Cache populated in {caching_time} '
                           f'seconds\n')
+        flush_wal.start()
+        flush_spill.start()
         print_cache.start()
         print_to_bot_logs(get_metrics())
         msg = await bot.get_channel(log_channel).send(content=f'Celestia has booted up and is now monitoring '
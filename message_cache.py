@@ -1,89 +1,253 @@
 import datetime
-import threading
+from collections import Counter, defaultdict
+from typing import Iterable
+
+from eviction_policy import EvictionPolicy, OldestEvictionPolicy
 from message_model import MessageModel
+from message_store import MessageStore, IndexedMessageStore
+from sorted_ids import SortedIds
 
 
 class MessageCache:
-    _lock: threading.Lock = None
+    """Bounded cache of message models.
+
+    Models live in a MessageStore, by default an IndexedMessageStore with O(1) lookups and sub-linear ordered inserts.
+    ColumnarMessageStore can be passed instead to trade some CPU for a much smaller footprint, and a store may come
+    already filled, as SnapshotMessageStore does when restoring a snapshot.
+
+    Size is bounded by eviction policies: max_cache_size always applies as an oldest-first limit, and any extra
+    policies (per-channel quota, byte budget) are checked after it. Evictions are counted per policy.
+
+    The cache also keeps the ordered ids of every channel, updated on each insert and removal, so per-channel resume
+    points and counts are available without scanning the whole cache. The approximate byte footprint of the cached
+    models and a histogram of their sizes are kept the same way, so metrics never walk the cache.
+
+    The cache has a single writer and no lock: every method is called on the event loop and none of them awaits, so
+    each one runs to completion before any other coroutine sees the cache. Threads never touch the cache itself;
+    snapshot writers iterate a frozen copy of the store taken with view.
+
+    With a spill set, evicted models move to that cold tier (a SqliteSpill) instead of being dropped, and
+    fetch_message_model falls back to it off the event loop when a lookup misses in memory, so edits and deletes of
+    old messages can still be logged.
+    """
     _max_cache_size: int = None
-    _cache: list[MessageModel] = None
-
-    def __init__(self, max_cache_size: int, cache=None):
-        if cache is None:
-            self._cache = []
-        else:
-            self._cache = cache
-            for i in range(len(self._cache)):
-                self._cache[i] = MessageModel(message=None, payload=None, dict=self._cache[i])
-        self._lock = threading.Lock()
+    _store: MessageStore = None
+    _policies: list[EvictionPolicy] = None
+    _evictions: Counter = None
+    _channels: dict[int, SortedIds] = None
+    _bytes: int = None
+    _size_histogram: Counter = None
+    _journal = None
+    _spill = None
+
+    def __init__(self, max_cache_size: int, cache=None, policies: list[EvictionPolicy] = None,
+                 store: MessageStore = None):
+        self._store = store if store is not None else IndexedMessageStore()
         self._max_cache_size = max_cache_size
+        self._policies = [OldestEvictionPolicy(max_cache_size)] + (policies if policies is not None else [])
+        self._evictions = Counter()
+        self._channels = {}
+        self._bytes = 0
+        self._size_histogram = Counter()
+        for message_id, channel_id, size in self._store.entries():
+            self._track(message_id, channel_id, size)
+        if cache is not None:
+            models = {}
+            for entry in cache:
+                model = MessageModel(message=None, payload=None, dict=entry)
+                models[model.message_id] = model
+            for message_id in sorted(models):
+                self._insert(models[message_id])
+        self._evict()
 
     def add_message_model(self, message: MessageModel, append: bool = True):
-        self._lock.acquire()
-        try:
-            if len(self._cache) == 0:
-                self._cache.append(message)
+        """Adds a model to the cache, replacing any cached model with the same id.
+
+        append is kept as a hint that the message is newer than everything cached; the ordered insert handles either
+        case, so out-of-order backfill may pass append=False or not.
+        """
+        cached = self._store.get(message.message_id)
+        if cached is None:
+            self._insert(message)
+            self._journal_put(message)
+        elif not cached.total_eq(message):
+            self._replace(cached, message)
+            self._journal_put(message)
+        self._evict()
+
+    def bulk_add(self, messages: Iterable[MessageModel]):
+        """Adds a batch of models, such as a page of channel history.
+
+        New models are merged into the store and the channel index in one pass per structure, cached models that
+        differ are replaced as in add_message_model, and eviction runs once after the whole batch. The batch should be
+        sorted by id; it is sorted again if it is not.
+        """
+        batch = {message.message_id: message for message in messages}
+        new_messages = []
+        for message_id in sorted(batch):
+            message = batch[message_id]
+            cached = self._store.get(message_id)
+            if cached is None:
+                new_messages.append(message)
+                self._journal_put(message)
+            elif not cached.total_eq(message):
+                self._replace(cached, message)
+                self._journal_put(message)
+        self._store.insert_many(new_messages)
+        channel_ids = defaultdict(list)
+        for message in new_messages:
+            channel_ids[message.channel_id].append(message.message_id)
+            self._account(message.__sizeof__(), 1)
+            for policy in self._policies:
+                policy.on_add(message.message_id, message.channel_id)
+        for channel_id, message_ids in channel_ids.items():
+            channel = self._channels.get(channel_id)
+            if channel is None:
+                self._channels[channel_id] = SortedIds(message_ids)
             else:
-                if append:
-                    if not self._cache[len(self._cache) - 1].total_eq(message):
-                        self._cache.append(message)
-                else:
-                    left: int = 0
-                    right: int = len(self._cache) - 1
-                    while left <= right:
-                        mid = (left + right) // 2
-                        if self._cache[mid] < message:
-                            left = mid + 1
-                        elif self._cache[mid] > message:
-                            right = mid - 1
-                        else:
-                            left = mid
-                            break
-                    if left >= len(self._cache) or not self._cache[left].total_eq(message):
-                        self._cache.insert(left, message)
-            if len(self._cache) > self._max_cache_size:
-                self._cache = (self._cache.append(message))[-self._max_cache_size:]
-        finally:
-            self._lock.release()
+                channel.update(message_ids)
+        self._evict()
 
     def get_message_model(self, message: MessageModel, update: bool = False,
                           delete: bool = False) -> MessageModel | None:
-        self._lock.acquire()
-        ret_value = None
-        try:
-            left: int = 0
-            right: int = len(self._cache) - 1
-            while left <= right:
-                mid = (left + right) // 2
-                if self._cache[mid] < message:
-                    left = mid + 1
-                elif self._cache[mid] > message:
-                    right = mid - 1
-                else:
-                    ret_value = self._cache[mid]
-                    if update:
-                        self._cache[mid] = message
-                    if delete:
-                        del self._cache[mid]
-                    break
-        finally:
-            self._lock.release()
+        ret_value = self._store.get(message.message_id)
+        if ret_value is not None:
+            if delete:
+                self._remove(message.message_id)
+                if self._journal is not None:
+                    self._journal.append_delete(message.message_id)
+                if self._spill is not None:
+                    self._spill.delete(message.message_id)
+            elif update:
+                self._replace(ret_value, message)
+                self._journal_put(message)
+                self._evict()
+        return ret_value
+
+    async def fetch_message_model(self, message: MessageModel, update: bool = False,
+                                  delete: bool = False) -> MessageModel | None:
+        """Like get_message_model, but a model missing from memory is looked up in the spill."""
+        ret_value = self.get_message_model(message, update=update, delete=delete)
+        if ret_value is not None or self._spill is None:
+            return ret_value
+        ret_value = await self._spill.get(message.message_id)
+        if ret_value is not None:
+            if delete:
+                self._spill.delete(message.message_id)
+            elif update:
+                self._spill.put(message)
         return ret_value
 
+    def get_previous(self, channel_id: int, message_id: int, limit: int) -> list[MessageModel]:
+        """Returns up to limit cached messages sent in a channel before message_id, newest first."""
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            return []
+        return [self._store.get(previous_id) for previous_id in channel.before(message_id, limit)]
+
     def get_max_time(self, channel_id: int | None, tzinfo: datetime.tzinfo) -> datetime.datetime:
-        for message in reversed(self._cache):
-            if channel_id is None or channel_id == message.channel_id:
-                return datetime.datetime.fromtimestamp(((message.message_id >> 22) + 1420070400000) / 1000, tz=tzinfo)
+        message_id = self.latest_id(channel_id)
+        if message_id is not None:
+            return datetime.datetime.fromtimestamp(((message_id >> 22) + 1420070400000) / 1000, tz=tzinfo)
         return datetime.datetime.min.replace(tzinfo=tzinfo)
 
     def get_cache(self) -> list[MessageModel]:
-        return self._cache
+        return list(self._store)
+
+    def view(self) -> MessageStore:
+        """Returns a frozen copy of the cached models that another thread can iterate, oldest first, while the cache
+        keeps changing. Taking it copies the store's containers but no models, so it is cheap enough for the loop."""
+        return self._store.freeze()
+
+    def set_journal(self, journal):
+        """Reports every later put and delete to journal (a CacheWal). Evictions are not journaled."""
+        self._journal = journal
+
+    def set_spill(self, spill):
+        """Moves every later evicted model to spill (a SqliteSpill) and serves cache misses from it."""
+        self._spill = spill
+
+    def get_eviction_counts(self) -> dict[str, int]:
+        return {policy.name: self._evictions[policy.name] for policy in self._policies}
+
+    def oldest_id(self, channel_id: int | None = None) -> int | None:
+        if channel_id is None:
+            return self._store.first_id()
+        channel = self._channels.get(channel_id)
+        return channel.first() if channel is not None else None
+
+    def latest_id(self, channel_id: int | None = None) -> int | None:
+        if channel_id is None:
+            return max([channel.last() for channel in self._channels.values()], default=None)
+        channel = self._channels.get(channel_id)
+        return channel.last() if channel is not None else None
+
+    def channel_len(self, channel_id: int) -> int:
+        channel = self._channels.get(channel_id)
+        return len(channel) if channel is not None else 0
+
+    def channel_count(self) -> int:
+        return len(self._channels)
 
     def len(self):
-        return len(self._cache)
+        return len(self._store)
+
+    def size(self) -> int:
+        """Approximate footprint of the cached models in bytes, as summed from MessageModel.__sizeof__."""
+        return self._bytes
+
+    def get_size_histogram(self) -> dict[int, int]:
+        """Number of cached models per entry size, keyed by the power of two bounding the size in bytes."""
+        return {bound: self._size_histogram[bound] for bound in sorted(self._size_histogram)
+                if self._size_histogram[bound] > 0}
+
+    def _insert(self, message: MessageModel):
+        self._store.insert(message)
+        self._track(message.message_id, message.channel_id, message.__sizeof__())
+
+    def _track(self, message_id: int, channel_id: int, size: int):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = SortedIds()
+        channel.add(message_id)
+        self._account(size, 1)
+        for policy in self._policies:
+            policy.on_add(message_id, channel_id)
+
+    def _replace(self, cached: MessageModel, message: MessageModel):
+        self._store.replace(message)
+        self._account(cached.__sizeof__(), -1)
+        self._account(message.__sizeof__(), 1)
+
+    def _remove(self, message_id: int) -> MessageModel:
+        message = self._store.remove(message_id)
+        channel = self._channels[message.channel_id]
+        channel.remove(message_id)
+        if len(channel) == 0:
+            del self._channels[message.channel_id]
+        self._account(message.__sizeof__(), -1)
+        for policy in self._policies:
+            policy.on_remove(message_id, message.channel_id)
+        return message
+
+    def _account(self, size: int, sign: int):
+        self._bytes += sign * size
+        self._size_histogram[1 << (size - 1).bit_length()] += sign
+
+    def _journal_put(self, message: MessageModel):
+        if self._journal is not None:
+            self._journal.append_put(message)
+
+    def _evict(self):
+        for policy in self._policies:
+            victim = policy.victim(self)
+            while victim is not None:
+                message = self._remove(victim)
+                if self._spill is not None:
+                    self._spill.put(message)
+                self._evictions[policy.name] += 1
+                victim = policy.victim(self)
 
     def __sizeof__(self) -> int:
-        cache_mem_size = 0
-        for i in range(self.len()):
-            cache_mem_size += self._cache[i].__sizeof__()
-        return cache_mem_size + self._cache.__sizeof__()
+        """Exact footprint of the store. Walks every entry, so prefer size() on hot paths."""
+        return self._store.__sizeof__()
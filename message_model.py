@@ -1,15 +1,57 @@
 import discord
 import json
 
+EMPTY_CONTENT = '*[Empty message body]*'
 
-def _list_attachments(attachments: list[discord.Attachment]) -> list[(str, bool)]:
-    str_list: list[(str, bool)] = []
-    for i in range(len(attachments)):
-        str_list.append((attachments[i].proxy_url, attachments[i].is_spoiler()))
-    return str_list
+_attachment_prefix = 'https://media.discordapp.net/attachments/'
+
+
+def _pack_url(url: str) -> str:
+    return url[len(_attachment_prefix):] if url.startswith(_attachment_prefix) else url
+
+
+def _unpack_url(packed: str) -> str:
+    return packed if packed.startswith('https://') else _attachment_prefix + packed
+
+
+def _list_attachments(attachments: list[discord.Attachment]) -> tuple[tuple[str, bool], ...]:
+    if len(attachments) == 0:
+        return ()
+    return tuple((_pack_url(attachment.proxy_url), attachment.is_spoiler()) for attachment in attachments)
+
+
+def jump_url(guild_id: int, channel_id: int, message_id: int) -> str:
+    return f'https://discord.com/channels/{guild_id}/{channel_id}/{message_id}'
+
+
+def update_to_dict(data: dict) -> dict | None:
+    """Converts the raw message of a message update event into a dict accepted by MessageModel(dict=...).
+
+    Returns None when the event does not carry every field a model needs, such as embed-only updates.
+    """
+    if 'author' not in data or 'content' not in data or 'attachments' not in data:
+        return None
+    stickers = data.get('sticker_items', [])
+    reference = data.get('message_reference')
+    return {'message_id': int(data['id']),
+            'channel_id': int(data['channel_id']),
+            'user_id': int(data['author']['id']),
+            'content': data['content'] if data['content'] != '' else EMPTY_CONTENT,
+            'sticker': int(stickers[0]['id']) if len(stickers) > 0 else 0,
+            'attachments': [(attachment['proxy_url'], attachment['filename'].startswith('SPOILER_'))
+                            for attachment in data['attachments']],
+            'reply_id': int(reference['message_id']) if reference is not None and 'message_id' in reference else 0}
 
 
 class MessageModel:
+    """Cached snapshot of a message.
+
+    Models are kept for hundreds of thousands of messages at once, so they use __slots__, keep the replied-to message
+    as a snowflake rather than a jump URL, and store attachment proxy URLs without their common prefix. Messages
+    without attachments or content share the same empty placeholders.
+    """
+    __slots__ = ('message_id', 'channel_id', 'user_id', 'content', 'sticker', 'reply_id', '_attachments')
+
     def __init__(self, message: discord.Message = None, payload: discord.RawMessageUpdateEvent |
                                                                  discord.RawMessageDeleteEvent = None, **kwargs):
         if message is None and payload is None and kwargs is None:
@@ -18,22 +60,52 @@ class MessageModel:
             self.message_id: int = message.id
             self.channel_id: int = message.channel.id
             self.user_id: int = message.author.id
-            self.content: str = message.content
+            self.content: str = message.content if message.content != '' else EMPTY_CONTENT
             self.sticker: int = 0 if len(message.stickers) <= 0 else message.stickers[0].id
-            self.attachments: list[(str, bool)] = _list_attachments(message.attachments)
-            self.reply_url: str = message.reference.jump_url if message.reference is not None else ''
-            if self.content == '':
-                self.content = '*[Empty message body]*'
+            self._attachments: tuple[tuple[str, bool], ...] = _list_attachments(message.attachments)
+            self.reply_id: int = (message.reference.message_id or 0) if message.reference is not None else 0
         elif payload is not None:
             self.message_id: int = payload.message_id
             self.channel_id: int = payload.channel_id
             self.user_id: int = 0
             self.content: str = ''
             self.sticker: int = 0
-            self.attachments: list[(str, bool)] = []
-            self.reply_url: str = ''
+            self._attachments: tuple[tuple[str, bool], ...] = ()
+            self.reply_id: int = 0
         else:
-            self.__dict__.update(kwargs['dict'])
+            self._from_dict(kwargs['dict'])
+
+    def _from_dict(self, model_dict: dict):
+        self.message_id = model_dict['message_id']
+        self.channel_id = model_dict['channel_id']
+        self.user_id = model_dict['user_id']
+        # share one placeholder string between all messages without a body
+        self.content = model_dict['content'] if model_dict['content'] != EMPTY_CONTENT else EMPTY_CONTENT
+        self.sticker = model_dict['sticker']
+        attachments = model_dict['attachments']
+        self._attachments = (tuple((_pack_url(url), bool(spoiler)) for url, spoiler in attachments)
+                             if len(attachments) > 0 else ())
+        if 'reply_id' in model_dict:
+            self.reply_id = model_dict['reply_id']
+        else:  # cache files written before reply ids were stored hold the jump url instead
+            reply_url: str = model_dict.get('reply_url', '')
+            self.reply_id = int(reply_url.rsplit('/', 1)[1]) if reply_url != '' else 0
+
+    def to_dict(self) -> dict:
+        return {'message_id': self.message_id,
+                'channel_id': self.channel_id,
+                'user_id': self.user_id,
+                'content': self.content,
+                'sticker': self.sticker,
+                'attachments': self.attachments,
+                'reply_id': self.reply_id}
+
+    @property
+    def attachments(self) -> list[tuple[str, bool]]:
+        return [(_unpack_url(url), is_spoiler) for url, is_spoiler in self._attachments]
+
+    def get_reply_url(self, guild_id: int) -> str:
+        return jump_url(guild_id, self.channel_id, self.reply_id) if self.reply_id != 0 else ''
 
     def __lt__(self, other):
         return self.message_id < other.message_id
@@ -54,15 +126,16 @@ class MessageModel:
         return self.message_id == other.message_id
 
     def __sizeof__(self) -> int:
-        attachment_size = 0
-        for attachment in self.attachments:
-            attachment_size += attachment.__sizeof__()
-        return (self.message_id.__sizeof__() +
+        attachment_size = self._attachments.__sizeof__()
+        for attachment in self._attachments:
+            attachment_size += attachment.__sizeof__() + attachment[0].__sizeof__()
+        return (super().__sizeof__() +
+                self.message_id.__sizeof__() +
                 self.channel_id.__sizeof__() +
                 self.user_id.__sizeof__() +
                 self.content.__sizeof__() +
                 self.sticker.__sizeof__() +
-                self.attachments.__sizeof__() +
+                self.reply_id.__sizeof__() +
                 attachment_size)
 
     def total_eq(self, other):
@@ -70,10 +143,10 @@ class MessageModel:
                 and self.sticker == other.sticker and self.attachment_eq(other))
 
     def attachment_eq(self, other):
-        if len(self.attachments) != len(other.attachments):
+        if len(self._attachments) != len(other._attachments):
             return False
-        for i in range(len(self.attachments)):
-            if self.attachments[i][0] != other.attachments[i][0]:
+        for i in range(len(self._attachments)):
+            if self._attachments[i][0] != other._attachments[i][0]:
                 return False
         return True
 
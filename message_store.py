@@ -0,0 +1,117 @@
+from abc import ABC, abstractmethod
+from typing import Iterator
+
+from message_model import MessageModel
+from sorted_ids import SortedIds
+
+
+class MessageStore(ABC):
+    """Storage engine behind MessageCache.
+
+    A store only keeps models ordered by message id; locking, eviction and persistence stay in MessageCache, so every
+    store behaves the same from the bot's point of view. insert and insert_many are only called for ids the store does
+    not hold yet and replace/remove only for ids it does.
+    """
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def __iter__(self):
+        pass
+
+    @abstractmethod
+    def get(self, message_id: int) -> MessageModel | None:
+        pass
+
+    @abstractmethod
+    def insert(self, message: MessageModel):
+        pass
+
+    def insert_many(self, messages: list[MessageModel]):
+        """Inserts a batch of messages sorted by id. Stores override this when they can merge a batch in one pass."""
+        for message in messages:
+            self.insert(message)
+
+    @abstractmethod
+    def replace(self, message: MessageModel):
+        pass
+
+    @abstractmethod
+    def remove(self, message_id: int) -> MessageModel:
+        pass
+
+    @abstractmethod
+    def first_id(self) -> int | None:
+        pass
+
+    def entries(self) -> Iterator[tuple[int, int, int]]:
+        """Yields (message id, channel id, model size) for every stored message, oldest first."""
+        for message in self:
+            yield message.message_id, message.channel_id, message.__sizeof__()
+
+    @abstractmethod
+    def freeze(self) -> 'MessageStore':
+        """Returns a read-only copy of the store that later changes to it do not affect.
+
+        Models are never mutated in place, so stores only copy their containers; the copy is iterated from a snapshot
+        thread while the original keeps changing on the loop.
+        """
+
+    def close(self):
+        """Releases any file the store or a frozen copy of it maps."""
+        pass
+
+
+class IndexedMessageStore(MessageStore):
+    """Models in a hash index keyed by message id, next to a chunked sorted list of ids.
+
+    Lookups, updates and deletes are O(1) and ordered inserts are sub-linear, so backfilling out-of-order history does
+    not degrade as the cache grows.
+    """
+
+    def __init__(self):
+        self._index: dict[int, MessageModel] = {}
+        self._order: SortedIds = SortedIds()
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def __iter__(self):
+        for message_id in self._order:
+            yield self._index[message_id]
+
+    def get(self, message_id: int) -> MessageModel | None:
+        return self._index.get(message_id)
+
+    def insert(self, message: MessageModel):
+        self._index[message.message_id] = message
+        self._order.add(message.message_id)
+
+    def insert_many(self, messages: list[MessageModel]):
+        for message in messages:
+            self._index[message.message_id] = message
+        self._order.update([message.message_id for message in messages])
+
+    def replace(self, message: MessageModel):
+        self._index[message.message_id] = message
+
+    def remove(self, message_id: int) -> MessageModel:
+        self._order.remove(message_id)
+        return self._index.pop(message_id)
+
+    def first_id(self) -> int | None:
+        return self._order.first()
+
+    def freeze(self) -> 'IndexedMessageStore':
+        frozen = IndexedMessageStore()
+        frozen._index = self._index.copy()
+        frozen._order = self._order.copy()
+        return frozen
+
+    def __sizeof__(self) -> int:
+        cache_mem_size = 0
+        for model in self._index.values():
+            cache_mem_size += model.__sizeof__()
+        return cache_mem_size + self._index.__sizeof__()
@@ -1,15 +1,19 @@
 import asyncio
 import datetime
+import logging
+import sqlite3
 import time
 import random
 from typing import Optional, Any
 
 import discord
-from discord.ext import commands
-from yt_dlp import YoutubeDL
-from urllib.parse import urlparse
+from discord.ext import commands, tasks
+from urllib.parse import parse_qs, urlparse
 
+from extraction_service import ExtractionService
+from search_cache import SearchCache
 from song import Song
+from tracked_audio_source import TrackedAudioSource
 
 ytdl_options = {
     'format': 'bestaudio/best',
@@ -20,13 +24,27 @@ ytdl_options = {
     'quiet': True,
     'no_warnings': True,
     'logtostderr': False,
-    'source_address': '0.0.0.0'
+    'source_address': '0.0.0.0',
+    'socket_timeout': 10
 }
 
 yt_netloc = ['www.youtube.com', 'youtube.com', 'youtu.be']
 
 num_query_choices = 5
 
+max_concurrent_extractions = 2
+extraction_timeout = 30
+
+prebuffer_frames = 150  # 3 seconds of 20ms frames
+prefetch_timeout = 5
+
+search_cache_path = '.cache/search.db'
+search_cache_ttl = 30 * 24 * 60 * 60
+search_cache_size = 10000
+
+stream_refresh_margin = 30 * 60  # re-extract queued stream URLs this many seconds before they expire
+stream_refresh_minutes = 5
+
 error_actions = ['do ten pushups',
                  'polish your eyes',
                  'do a barrel roll',
@@ -57,6 +75,28 @@ class MusicBot(commands.Cog):
         self.playlist_message: dict[str, Any] = {}
         self.repeat: bool = False
         self.queries: dict[discord.Member, tuple[discord.Message, list[Song]]] = {}
+        self.prefetched: Optional[Song] = None  # next song, with its ffmpeg process started and buffering
+        self.prefetch_task: Optional[asyncio.Task] = None
+        self.song_ended_at: Optional[float] = None
+        self.last_gap: Optional[float] = None
+        self.gap_total: float = 0
+        self.gap_count: int = 0
+        self.streams_refreshed: int = 0
+        self.extractor: ExtractionService = ExtractionService(ytdl_options, max_workers=max_concurrent_extractions,
+                                                              timeout=extraction_timeout)
+        # background refreshes get a lane of their own, so a long queue never holds up a search
+        self.refresher: ExtractionService = ExtractionService(ytdl_options, max_workers=1, timeout=extraction_timeout)
+        self.search_cache: SearchCache = SearchCache(search_cache_path, ttl=search_cache_ttl,
+                                                     max_entries=search_cache_size)
+
+    async def cog_load(self):
+        self.refresh_streams.start()
+
+    async def cog_unload(self):
+        self.refresh_streams.cancel()
+        self.extractor.shutdown()
+        self.refresher.shutdown()
+        self.search_cache.close()
 
     @commands.command()
     async def join(self, ctx: commands.Context):
@@ -87,7 +127,7 @@ class MusicBot(commands.Cog):
             if len(arg) == 0:
                 await self._user_error('I can\'t search for nothing.', ctx)
             else:
-                search_result, exec_time = self._ytdlp_search(arg, num_query_choices, ctx)
+                search_result, exec_time = await self._ytdlp_search(arg, num_query_choices, ctx)
                 if search_result is None:
                     return
                 else:
@@ -101,7 +141,9 @@ class MusicBot(commands.Cog):
 
     def _create_search_embed(self, author: discord.Member, query: str, search_result: list[Song],
                              exec_time: float) -> discord.Embed:
-        embed = discord.Embed(title=f'Searched for "{query}"', description=f'Query time: {round(exec_time, 3)} seconds',
+        embed = discord.Embed(title=f'Searched for "{query}"',
+                              description=f'Query time: {round(exec_time, 3)} seconds '
+                                          f'(cache hit rate {round(self.search_cache.hit_rate() * 100)}%)',
                               color=author.color)
         embed.set_author(name=f'{author.global_name} ({author.display_name})',
                          icon_url=author.display_avatar.url)
@@ -130,15 +172,21 @@ class MusicBot(commands.Cog):
                     elif url.path != '/watch' and url.netloc != 'youtu.be':
                         await self._user_error('This is not a link to a video on YouTube.')
                     else:  # should be a YouTube video that can be directly searched
-                        with YoutubeDL(ytdl_options) as ytdl:
-                            try:
-                                await self.cmd_channel.typing()
-                                info_dict = ytdl.extract_info(url=arg, download=False, process=True)
-                                song_result = Song(info_dict, ctx.author)
-                            except:
-                                await self._user_error('Could not parse your search.', ctx)
+                        video_id = url.path[1:] if url.netloc == 'youtu.be' else parse_qs(url.query).get('v', [''])[0]
+                        info_dict = await self._use_cache(self.search_cache.get_video, video_id)
+                        cached = info_dict is not None
+                        if not cached:
+                            info_dict = await self._ytdlp_extract(arg, ctx)
+                            if info_dict is None:
                                 return
-                            await self._add_to_playlist(song_result)
+                        try:
+                            song_result = Song(info_dict, ctx.author)
+                        except:
+                            await self._user_error('Could not parse your search.', ctx)
+                            return
+                        if not cached:  # only metadata that parsed as a song is worth caching
+                            await self._use_cache(self.search_cache.put_video, info_dict)
+                        await self._add_to_playlist(song_result)
                 else:
                     search_result, exec_time = await self._ytdlp_search(arg, 1, ctx)
                     if search_result is None:
@@ -161,6 +209,7 @@ class MusicBot(commands.Cog):
             else:
                 next_song = self.playlist.pop(int(arg) - 1)
                 self.playlist.insert(0, next_song)
+                self._schedule_prefetch()
                 await self._end_song()
                 await self._info(None, f'Skipping current song to play {next_song.title}.', ctx)
 
@@ -255,6 +304,7 @@ class MusicBot(commands.Cog):
                 await self._user_error('There are no songs in the queue to shuffle.', ctx)
             else:
                 random.shuffle(self.playlist)
+                self._schedule_prefetch()
                 await self._info(None, 'Queue has been shuffled.', ctx)
 
     @commands.command()
@@ -266,6 +316,7 @@ class MusicBot(commands.Cog):
                 await self._user_error('You do not have control over the music bot.', ctx)
             else:
                 self.playlist = []
+                self._schedule_prefetch()
                 await self._info(None, 'Queue has been cleared.', ctx)
 
     @commands.command()
@@ -281,6 +332,7 @@ class MusicBot(commands.Cog):
                 await self._user_error('You do not have control over the music bot.', ctx)
             else:
                 song = self.playlist.pop(int(arg) - 1)
+                self._schedule_prefetch()
                 await self._info(None, f'Dequeued {int(arg)}: {song.title}.', ctx)
 
     @commands.command()
@@ -410,6 +462,9 @@ class MusicBot(commands.Cog):
                                 inline=False)
                 embed.add_field(name='\u200b', value=f'[Link to video](https://www.youtube.com/watch?v={song.id})',
                                 inline=False)
+                if self.last_gap is not None:
+                    embed.set_footer(text=f'Gap before this song: {round(self.last_gap * 1000)}ms, average '
+                                          f'{round(self.gap_total / self.gap_count * 1000)}ms')
                 await self.cmd_channel.send(embed=embed, reference=ctx.message, mention_author=False)
 
     @commands.Cog.listener()
@@ -455,17 +510,39 @@ class MusicBot(commands.Cog):
         self.connection = await self.voice_channel.connect(self_deaf=True)
 
     async def _ytdlp_search(self, query: str, num_search: int, ctx: commands.Context) -> tuple[Optional[dict], float]:
-        with YoutubeDL(ytdl_options) as ytdl:
-            try:
-                await self.cmd_channel.typing()
-                start = time.time()
-                search_result = ytdl.extract_info(f'ytsearch{num_search}:{query}', download=False,
-                                                  process=True)['entries']
-                exec_time = time.time() - start
-                return search_result, exec_time
-            except:
-                await self._user_error('Could not parse your search.', ctx)
+        start = time.time()
+        search_result = await self._use_cache(self.search_cache.get_query, query, num_search)
+        if search_result is None:
+            info_dict = await self._ytdlp_extract(f'ytsearch{num_search}:{query}', ctx)
+            if info_dict is None:
                 return None, -1
+            search_result = info_dict['entries']
+            await self._use_cache(self.search_cache.put_query, query, num_search, search_result)
+        return search_result, time.time() - start
+
+    @staticmethod
+    async def _use_cache(method, *args):
+        # the cache's queries and writes share a lock and commit, so they stay off the event loop; the cache only saves
+        # time, so a failed lookup counts as a miss and a failed write (including results missing a metadata field) is
+        # not worth failing the command over
+        try:
+            return await asyncio.to_thread(method, *args)
+        except (sqlite3.Error, KeyError):
+            return None
+
+    async def _ytdlp_extract(self, url: str, ctx: commands.Context) -> Optional[dict]:
+        if self.extractor.is_busy():
+            searches_ahead = max_concurrent_extractions + self.extractor.queued
+            await self._info(None, f'Your search will start once the {searches_ahead} search(es) ahead of it are done.',
+                             ctx)
+        try:
+            await self.cmd_channel.typing()
+            return await self.extractor.extract(url)
+        except asyncio.TimeoutError:
+            await self._user_error('Your search took too long.', ctx)
+        except:
+            await self._user_error('Could not parse your search.', ctx)
+        return None
 
     async def _add_to_playlist(self, song: Song):
         await self._info(None, f'Added {song.title} by {song.uploader} to the queue.',
@@ -473,10 +550,8 @@ class MusicBot(commands.Cog):
         self.playlist.append(song)
         if self.current_song is None:
             await self._play_song()
-
-    async def _delete_current_song_message(self):
-        await self.current_song_message.delete()
-        self.current_song_message = None
+        else:
+            self._schedule_prefetch()
 
     async def _edit_playlist_nav_message(self, page_number: int, reaction: str):
         message = self.playlist_message['message']
@@ -495,27 +570,122 @@ class MusicBot(commands.Cog):
             self.playlist_message = {}
 
     async def _play_song(self):
-        self.current_song = self.playlist.pop(0)
-        source = self.current_song.source
+        source = None
+        while source is None:
+            if len(self.playlist) == 0:
+                self.current_song = None
+                self.song_ended_at = None
+                return
+            self.current_song = self.playlist.pop(0)
+            source = await self._take_source(self.current_song)
+            if source is None:
+                await self._info(None, f'Could not load {self.current_song.title} by {self.current_song.uploader}, '
+                                       f'so it was skipped.', user=self.current_song.queuer)
         if self.connection is None:
             await self._join(self.current_song.queuer)
-        self.connection.play(source,
-                             after=lambda e: asyncio.run_coroutine_threadsafe(self._end_song(), self.bot.loop))
+        self.connection.play(source, after=lambda e: self._on_song_finished())
+        if self.song_ended_at is not None:
+            self.last_gap = time.perf_counter() - self.song_ended_at
+            self.gap_total += self.last_gap
+            self.gap_count += 1
+            self.song_ended_at = None
+        self._schedule_prefetch()
         embed = discord.Embed(title=f'Now playing {self.current_song.title} by {self.current_song.uploader}',
                               description=f'Requested by {self.current_song.queuer}, '
                                           f'Length {str(datetime.timedelta(seconds=self.current_song.duration))}',
                               color=self.current_song.queuer.color)
         self.current_song_message = await self.cmd_channel.send(embed=embed)
 
+    def _on_song_finished(self):
+        # called from the voice client's player thread
+        self.song_ended_at = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(self._end_song(), self.bot.loop)
+
     async def _end_song(self, play_next: bool = True):
-        if self.current_song_message is not None:
-            await self._delete_current_song_message()
+        finished_song_message = self.current_song_message
+        self.current_song_message = None
         if self.repeat and self.current_song is not None:
-            self.current_song.refresh_source()
             self.playlist.append(self.current_song)
         self.current_song = None
         if not self.is_stopped and play_next and len(self.playlist) > 0:
             asyncio.run_coroutine_threadsafe(self._play_song(), self.bot.loop)
+        else:
+            self.song_ended_at = None
+        # the next song starts before the old now-playing message is deleted
+        if finished_song_message is not None:
+            await finished_song_message.delete()
+
+    def _schedule_prefetch(self):
+        if self.prefetch_task is None or self.prefetch_task.done():
+            self.prefetch_task = asyncio.create_task(self._prefetch_next())
+
+    async def _prefetch_next(self):
+        """Starts the ffmpeg process of the next song and buffers its first seconds while the current one plays, so
+        the handoff does not wait on the stream. Follows the head of the queue if it changes meanwhile."""
+        while True:
+            if self.prefetched is not None and self.prefetched is self.current_song:
+                return  # its playback is starting, and _take_source hands its source over
+            song = self.playlist[0] if len(self.playlist) > 0 and self.current_song is not None else None
+            if song is self.current_song:  # the same song queued twice through repeat
+                song = None
+            if song is self.prefetched:
+                return
+            self._discard_prefetch()
+            if song is None:
+                return
+            self.prefetched = song
+            try:
+                if song.expires_within(stream_refresh_margin):
+                    await self._refresh_stream(song)
+                    if self.prefetched is not song:
+                        continue
+                await asyncio.to_thread(song.create_source().prebuffer, prebuffer_frames)
+            except Exception:
+                self._discard_prefetch()
+                return
+
+    @tasks.loop(minutes=stream_refresh_minutes)
+    async def refresh_streams(self):
+        """Re-extracts the stream URLs of queued songs that expire soon, so no song reaches playback with a dead URL.
+        The extractions run one at a time on the refresher, earliest in the queue first."""
+        # songs from the search cache have no URL yet; prefetch and playback resolve theirs
+        expiring = [song for song in self.playlist
+                    if song.source_url is not None and song.expires_within(stream_refresh_margin)]
+        await asyncio.gather(*[self._refresh_stream(song, self.refresher) for song in expiring])
+
+    async def _refresh_stream(self, song: Song, extractor: Optional[ExtractionService] = None):
+        extractor = extractor if extractor is not None else self.extractor
+        try:
+            song.update_stream(await extractor.extract(f'https://www.youtube.com/watch?v={song.id}'))
+            self.streams_refreshed += 1
+        except Exception as e:  # keep the old URL; playback refreshes it again if it did expire
+            logging.warning(f'Could not refresh the stream of {song.id}: {e!r}')
+
+    async def _take_source(self, song: Song) -> Optional[TrackedAudioSource]:
+        """Returns the prefetched source of song once its buffer is filled, or a fresh source if it was not
+        prefetched. Returns None if song has no stream URL, as when it came from the search cache and resolving its
+        stream failed."""
+        if self.prefetched is song and self.prefetch_task is not None:
+            try:
+                await asyncio.wait_for(asyncio.shield(self.prefetch_task), prefetch_timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                if self.prefetched is song and song.source is not None:
+                    self.prefetched = None
+                    return song.source
+        if self.prefetched is song:
+            self._discard_prefetch()
+        if song.expires_within(0):
+            await self._refresh_stream(song)
+        if song.source_url is None:
+            return None
+        return song.create_source()
+
+    def _discard_prefetch(self):
+        if self.prefetched is not None:
+            self.prefetched.release_source()
+            self.prefetched = None
 
     def _has_control(self, user: discord.User):
         return self.public or user in self.controllers
@@ -531,6 +701,7 @@ class MusicBot(commands.Cog):
             await self._end_song()
             await self.connection.disconnect()
             self.connection = None
+        self._discard_prefetch()
         self.controllers = []
         self.public = False
         self.current_song = None
@@ -0,0 +1,109 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+_schema = ['CREATE TABLE IF NOT EXISTS videos (id TEXT PRIMARY KEY, title TEXT NOT NULL, uploader TEXT NOT NULL, '
+           'duration INTEGER NOT NULL, upload_date TEXT NOT NULL, stored REAL NOT NULL, accessed REAL NOT NULL)',
+           'CREATE TABLE IF NOT EXISTS queries (query TEXT PRIMARY KEY, video_ids TEXT NOT NULL, stored REAL NOT NULL, '
+           'accessed REAL NOT NULL)',
+           'CREATE INDEX IF NOT EXISTS videos_by_access ON videos (accessed)',
+           'CREATE INDEX IF NOT EXISTS queries_by_access ON queries (accessed)']
+_metadata_keys = ['id', 'title', 'uploader', 'duration', 'upload_date']
+
+
+def normalize_query(query: str, num_results: int) -> str:
+    return f'{num_results}:' + ' '.join(query.lower().split())
+
+
+class SearchCache:
+    """Persistent cache of yt-dlp search results and video metadata, in a local SQLite database.
+
+    Queries map to the ids of their results and ids map to what Song needs besides the stream URL, which expires
+    within hours and is resolved again at play time. Entries older than ttl seconds are treated as missing, and the
+    least recently used ones are deleted once a table holds more than max_entries rows. Every method takes the
+    connection's lock and lookups commit their access times, so all of them are meant to run off the event loop.
+    """
+
+    def __init__(self, path: str, ttl: float, max_entries: int):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock: threading.Lock = threading.Lock()
+        self._connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in _schema:
+            self._connection.execute(statement)
+        self._connection.commit()
+
+    def hit_rate(self) -> float:
+        return self.hits / (self.hits + self.misses) if self.hits + self.misses > 0 else 0
+
+    def get_query(self, query: str, num_results: int) -> list[dict] | None:
+        """Returns the metadata of a cached search's results, or None if any part of it is missing or stale."""
+        key = normalize_query(query, num_results)
+        with self._lock:
+            row = self._connection.execute('SELECT video_ids FROM queries WHERE query = ? AND stored > ?',
+                                           (key, time.time() - self.ttl)).fetchone()
+            videos = [self._get_video(video_id) for video_id in json.loads(row[0])] if row is not None else [None]
+            if any(video is None for video in videos):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(key, [video['id'] for video in videos])
+        return videos
+
+    def get_video(self, video_id: str) -> dict | None:
+        with self._lock:
+            video = self._get_video(video_id)
+            if video is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._touch(None, [video_id])
+        return video
+
+    def put_query(self, query: str, num_results: int, info_dicts: list[dict]):
+        now = time.time()
+        with self._lock, self._connection:
+            self._put_videos(info_dicts, now)
+            self._connection.execute('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                                     (normalize_query(query, num_results),
+                                      json.dumps([info_dict['id'] for info_dict in info_dicts]), now, now))
+            self._trim('queries')
+
+    def put_video(self, info_dict: dict):
+        with self._lock, self._connection:
+            self._put_videos([info_dict], time.time())
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _get_video(self, video_id: str) -> dict | None:
+        row = self._connection.execute('SELECT id, title, uploader, duration, upload_date FROM videos '
+                                       'WHERE id = ? AND stored > ?', (video_id, time.time() - self.ttl)).fetchone()
+        return dict(zip(_metadata_keys, row)) if row is not None else None
+
+    def _touch(self, query: str | None, video_ids: list[str]):
+        # one transaction for the access times of a whole lookup
+        now = time.time()
+        with self._connection:
+            if query is not None:
+                self._connection.execute('UPDATE queries SET accessed = ? WHERE query = ?', (now, query))
+            self._connection.executemany('UPDATE videos SET accessed = ? WHERE id = ?',
+                                         [(now, video_id) for video_id in video_ids])
+
+    def _put_videos(self, info_dicts: list[dict], now: float):
+        self._connection.executemany('INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                     [tuple(info_dict[key] for key in _metadata_keys) + (now, now)
+                                      for info_dict in info_dicts])
+        self._trim('videos')
+
+    def _trim(self, table: str):
+        self._connection.execute(f'DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} ORDER BY accessed '
+                                 f'LIMIT max(0, (SELECT count(*) FROM {table}) - ?))', (self.max_entries,))
@@ -0,0 +1,119 @@
+import bisect
+import heapq
+from array import array
+from typing import Iterator
+
+from cache_snapshot import MappedSnapshot
+from message_model import MessageModel
+from message_store import MessageStore
+
+
+class _EmptySnapshot:
+    # stands in for a snapshot whose rows have all been masked, once its file is closed
+    ids: array = array('Q')
+    channels: array = array('Q')
+    sizes: array = array('I')
+
+    def __len__(self) -> int:
+        return 0
+
+    def acquire(self) -> '_EmptySnapshot':
+        return self
+
+    def close(self):
+        pass
+
+
+# snapshot rows are decoded only when read; replaced or removed rows are masked and every later change is in overlay
+class SnapshotMessageStore(MessageStore):
+    def __init__(self, snapshot: MappedSnapshot, overlay: MessageStore):
+        self._snapshot: MappedSnapshot | _EmptySnapshot = snapshot
+        self._overlay: MessageStore = overlay
+        self._masked: bytearray = bytearray(len(snapshot))
+        self._num_masked: int = 0
+        self._head: int = 0
+
+    def __len__(self) -> int:
+        return len(self._snapshot) - self._num_masked + len(self._overlay)
+
+    def __iter__(self):
+        return heapq.merge(self._snapshot_messages(), self._overlay, key=lambda message: message.message_id)
+
+    def get(self, message_id: int) -> MessageModel | None:
+        message = self._overlay.get(message_id)
+        if message is None:
+            row = self._find(message_id)
+            if row is not None:
+                message = MessageModel(dict=self._snapshot.message(row))
+        return message
+
+    def insert(self, message: MessageModel):
+        self._overlay.insert(message)
+
+    def insert_many(self, messages: list[MessageModel]):
+        self._overlay.insert_many(messages)
+
+    def replace(self, message: MessageModel):
+        if self._overlay.get(message.message_id) is not None:
+            self._overlay.replace(message)
+        else:
+            self._mask(self._find(message.message_id))
+            self._overlay.insert(message)
+
+    def remove(self, message_id: int) -> MessageModel:
+        if self._overlay.get(message_id) is not None:
+            return self._overlay.remove(message_id)
+        row = self._find(message_id)
+        message = MessageModel(dict=self._snapshot.message(row))
+        self._mask(row)
+        return message
+
+    def first_id(self) -> int | None:
+        while self._head < len(self._snapshot) and self._masked[self._head]:
+            self._head += 1
+        snapshot_first = self._snapshot.ids[self._head] if self._head < len(self._snapshot) else None
+        overlay_first = self._overlay.first_id()
+        if snapshot_first is None or overlay_first is None:
+            return overlay_first if snapshot_first is None else snapshot_first
+        return min(snapshot_first, overlay_first)
+
+    def entries(self) -> Iterator[tuple[int, int, int]]:
+        ids = self._snapshot.ids
+        channels = self._snapshot.channels
+        sizes = self._snapshot.sizes
+        snapshot_entries = ((ids[row], channels[row], sizes[row]) for row in range(len(ids)) if not self._masked[row])
+        return heapq.merge(snapshot_entries, self._overlay.entries())
+
+    def freeze(self) -> 'SnapshotMessageStore':
+        # the mapped file itself never changes, only the mask and the overlay do
+        frozen = SnapshotMessageStore(self._snapshot.acquire(), self._overlay.freeze())
+        frozen._masked = self._masked[:]
+        frozen._num_masked = self._num_masked
+        return frozen
+
+    def close(self):
+        self._snapshot.close()
+        self._snapshot = _EmptySnapshot()
+        self._masked = bytearray()
+        self._num_masked = 0
+        self._head = 0
+
+    def _find(self, message_id: int) -> int | None:
+        row = bisect.bisect_left(self._snapshot.ids, message_id)
+        if row < len(self._snapshot) and self._snapshot.ids[row] == message_id and not self._masked[row]:
+            return row
+        return None
+
+    def _mask(self, row: int):
+        self._masked[row] = 1
+        self._num_masked += 1
+        if self._num_masked == len(self._snapshot):
+            self.close()
+
+    def _snapshot_messages(self) -> Iterator[MessageModel]:
+        for row in range(len(self._snapshot)):
+            if not self._masked[row]:
+                yield MessageModel(dict=self._snapshot.message(row))
+
+    def __sizeof__(self) -> int:
+        return self._overlay.__sizeof__() + self._masked.__sizeof__()
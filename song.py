@@ -1,4 +1,8 @@
 import datetime
+import time
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
 import discord
 from tracked_audio_source import TrackedAudioSource
 
@@ -9,6 +13,13 @@ ffmpeg_options = {
 }
 
 
+def stream_expiry(url: Optional[str]) -> Optional[float]:
+    if url is None:
+        return None
+    expire = parse_qs(urlparse(url).query).get('expire')
+    return float(expire[0]) if expire is not None and expire[0].isnumeric() else None
+
+
 class Song:
     def __init__(self, info_dict: dict, queuer: discord.Member):
         self.id: str = info_dict['id']
@@ -17,8 +28,25 @@ class Song:
         self.duration: int = int(info_dict['duration'])
         self.upload_date: datetime.date = datetime.datetime.strptime(info_dict['upload_date'], '%Y%m%d').date()
         self.queuer: discord.Member = queuer
+        self.source_url: Optional[str] = info_dict.get('url')
+        self.expires_at: Optional[float] = stream_expiry(self.source_url)
+        self.source: Optional[TrackedAudioSource] = None
+
+    def expires_within(self, seconds: float) -> bool:
+        if self.source_url is None:  # built from cached metadata, so it has no URL yet
+            return True
+        return self.expires_at is not None and self.expires_at - time.time() < seconds
+
+    def update_stream(self, info_dict: dict):
         self.source_url = info_dict['url']
-        self.source: TrackedAudioSource = TrackedAudioSource(self.source_url, **ffmpeg_options)
+        self.expires_at = stream_expiry(self.source_url)
 
-    def refresh_source(self):
+    def create_source(self) -> TrackedAudioSource:
+        # ffmpeg only starts here, right before the song plays; each playback, including repeats, needs its own
         self.source = TrackedAudioSource(self.source_url, **ffmpeg_options)
+        return self.source
+
+    def release_source(self):
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
@@ -0,0 +1,141 @@
+import bisect
+
+
+class SortedIds:
+    """Sorted list of message ids, split into chunks of bounded length.
+
+    Inserting or removing an id only shifts the chunk it lives in, so ordered inserts stay cheap even when the cache
+    holds hundreds of thousands of entries. Appending a new maximum, the common case for live messages, touches only
+    the last chunk.
+    """
+    _load: int = 1000
+
+    def __init__(self, ids: list[int] = None):
+        self._build(ids if ids else [])
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def __reversed__(self):
+        for chunk in reversed(self._chunks):
+            yield from reversed(chunk)
+
+    def __contains__(self, message_id: int) -> bool:
+        pos = bisect.bisect_left(self._maxes, message_id)
+        if pos == len(self._maxes):
+            return False
+        chunk = self._chunks[pos]
+        return chunk[bisect.bisect_left(chunk, message_id)] == message_id
+
+    def add(self, message_id: int):
+        if len(self._chunks) == 0:
+            self._chunks.append([message_id])
+            self._maxes.append(message_id)
+        else:
+            pos = bisect.bisect_left(self._maxes, message_id)
+            if pos == len(self._maxes):
+                pos -= 1
+                self._chunks[pos].append(message_id)
+                self._maxes[pos] = message_id
+            else:
+                bisect.insort(self._chunks[pos], message_id)
+            self._split(pos)
+        self._len += 1
+
+    def update(self, ids: list[int]):
+        """Adds a sorted batch of ids in one pass, extending each chunk the batch falls into only once."""
+        if len(self._chunks) == 0:
+            self._build(list(ids))
+            return
+        pos = 0
+        start = 0
+        touched = []
+        while start < len(ids):
+            pos = bisect.bisect_left(self._maxes, ids[start], lo=pos)
+            if pos == len(self._maxes):
+                pos -= 1
+                end = len(ids)
+            else:
+                end = bisect.bisect_right(ids, self._maxes[pos], lo=start)
+            chunk = self._chunks[pos]
+            chunk.extend(ids[start:end])
+            chunk.sort()
+            self._maxes[pos] = chunk[-1]
+            touched.append(pos)
+            start = end
+        self._len += len(ids)
+        for pos in reversed(touched):
+            self._split(pos)
+
+    def remove(self, message_id: int) -> bool:
+        pos = bisect.bisect_left(self._maxes, message_id)
+        if pos == len(self._maxes):
+            return False
+        chunk = self._chunks[pos]
+        idx = bisect.bisect_left(chunk, message_id)
+        if chunk[idx] != message_id:
+            return False
+        del chunk[idx]
+        self._len -= 1
+        if len(chunk) == 0:
+            del self._chunks[pos]
+            del self._maxes[pos]
+        else:
+            self._maxes[pos] = chunk[-1]
+        return True
+
+    def before(self, message_id: int, limit: int) -> list[int]:
+        """Returns up to limit ids smaller than message_id, largest first."""
+        ids = []
+        pos = min(bisect.bisect_left(self._maxes, message_id), len(self._chunks) - 1)
+        end = bisect.bisect_left(self._chunks[pos], message_id) if pos >= 0 else 0
+        while pos >= 0 and len(ids) < limit:
+            chunk = self._chunks[pos]
+            ids.extend(reversed(chunk[max(0, end - (limit - len(ids))):end]))
+            pos -= 1
+            end = len(self._chunks[pos]) if pos >= 0 else 0
+        return ids
+
+    def copy(self) -> 'SortedIds':
+        copied = SortedIds()
+        copied._chunks = [chunk[:] for chunk in self._chunks]
+        copied._maxes = self._maxes[:]
+        copied._len = self._len
+        return copied
+
+    def first(self) -> int | None:
+        return self._chunks[0][0] if self._len > 0 else None
+
+    def last(self) -> int | None:
+        return self._chunks[-1][-1] if self._len > 0 else None
+
+    def pop_first(self) -> int:
+        chunk = self._chunks[0]
+        message_id = chunk.pop(0)
+        self._len -= 1
+        if len(chunk) == 0:
+            del self._chunks[0]
+            del self._maxes[0]
+        return message_id
+
+    def _build(self, ids: list[int]):
+        self._chunks: list[list[int]] = []
+        self._maxes: list[int] = []
+        for start in range(0, len(ids), self._load):
+            chunk = ids[start:start + self._load]
+            self._chunks.append(chunk)
+            self._maxes.append(chunk[-1])
+        self._len: int = len(ids)
+
+    def _split(self, pos: int):
+        chunk = self._chunks[pos]
+        if len(chunk) > 2 * self._load:
+            # a batch can grow a chunk far past the bound, so it is cut into as many chunks as needed at once
+            starts = range(0, len(chunk) - self._load, self._load)
+            pieces = [chunk[start:start + self._load] for start in starts[:-1]] + [chunk[starts[-1]:]]
+            self._chunks[pos:pos + 1] = pieces
+            self._maxes[pos:pos + 1] = [piece[-1] for piece in pieces]
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from message_model import MessageModel
+
+_schema = ['CREATE TABLE IF NOT EXISTS messages (message_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL, '
+           'user_id INTEGER NOT NULL, content TEXT NOT NULL, sticker INTEGER NOT NULL, attachments TEXT NOT NULL, '
+           'reply_id INTEGER NOT NULL)',
+           'CREATE INDEX IF NOT EXISTS messages_by_channel ON messages (channel_id, message_id)']
+_missing = object()
+_columns = 'message_id, channel_id, user_id, content, sticker, attachments, reply_id'
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+
+def _row(message: MessageModel) -> tuple:
+    return (message.message_id, message.channel_id, message.user_id, message.content, message.sticker,
+            json.dumps(message.attachments), message.reply_id)
+
+
+class SqliteSpill:
+    """Cold tier for MessageCache: messages evicted from memory are kept in a local SQLite database.
+
+    Writes are queued on the event loop and written in one transaction per flush on a worker thread; reads are
+    primary-key lookups on a separate connection, also run on a worker thread, and see queued writes before they reach
+    the database. Messages older than retention_days are pruned on flush.
+    """
+
+    def __init__(self, path: str, retention_days: int):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path: str = path
+        self.retention_days: int = retention_days
+        self.rows_written: int = 0
+        self._reader: sqlite3.Connection = _connect(path)
+        for statement in _schema:
+            self._reader.execute(statement)
+        self._reader.commit()
+        self._writer: sqlite3.Connection = _connect(path)
+        self._io_lock: threading.Lock = threading.Lock()
+        self._read_lock: threading.Lock = threading.Lock()
+        # message id -> model to write, or None to delete
+        self._pending: dict[int, MessageModel | None] = {}
+        self._flushing: dict[int, MessageModel | None] = {}
+
+    def put(self, message: MessageModel):
+        self._pending[message.message_id] = message
+
+    def delete(self, message_id: int):
+        self._pending[message_id] = None
+
+    async def get(self, message_id: int) -> MessageModel | None:
+        queued = self._queued(message_id)
+        if queued is not _missing:
+            return queued
+        message = await asyncio.to_thread(self._read, message_id)
+        # a change queued while the row was being read is newer than the row
+        queued = self._queued(message_id)
+        return message if queued is _missing else queued
+
+    async def flush(self) -> int:
+        """Writes every queued change in a worker thread and returns how many there were."""
+        if len(self._pending) == 0 or len(self._flushing) > 0:
+            return 0
+        self._flushing, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write, self._flushing)
+        except Exception:
+            # keep the batch so it is retried, unless newer changes to the same messages are already queued
+            self._pending = {**self._flushing, **self._pending}
+            raise
+        finally:
+            num_rows = len(self._flushing)
+            self._flushing = {}
+        return num_rows
+
+    def close(self):
+        with self._io_lock:
+            self._writer.close()
+        with self._read_lock:
+            self._reader.close()
+
+    def _queued(self, message_id: int) -> MessageModel | None | object:
+        for queued in [self._pending, self._flushing]:
+            if message_id in queued:
+                return queued[message_id]
+        return _missing
+
+    def _read(self, message_id: int) -> MessageModel | None:
+        with self._read_lock:
+            row = self._reader.execute(f'SELECT {_columns} FROM messages WHERE message_id = ?',
+                                       (message_id,)).fetchone()
+        if row is None:
+            return None
+        return MessageModel(dict={'message_id': row[0], 'channel_id': row[1], 'user_id': row[2], 'content': row[3],
+                                  'sticker': row[4], 'attachments': json.loads(row[5]), 'reply_id': row[6]})
+
+    def _write(self, batch: dict[int, MessageModel | None]):
+        # oldest snowflake still kept: the retention cutoff in Discord epoch milliseconds, shifted into id position
+        cutoff = max(0, int(time.time() * 1000 - 1420070400000 - self.retention_days * 86400000)) << 22
+        with self._io_lock:
+            with self._writer:
+                self._writer.executemany(f'INSERT OR REPLACE INTO messages ({_columns}) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                         [_row(message) for message in batch.values() if message is not None])
+                self._writer.executemany('DELETE FROM messages WHERE message_id = ?',
+                                         [(message_id,) for message_id, message in batch.items() if message is None])
+                self._writer.execute('DELETE FROM messages WHERE message_id < ?', (cutoff,))
+        self.rows_written += len(batch)
+
@@ -0,0 +1,35 @@
+import time
+from collections import OrderedDict
+
+
+class StickerCache:
+    """LRU of sticker names by sticker id, with entries expiring after ttl seconds.
+
+    Sticker names almost never change, so names seen on the guild or on incoming messages are kept here and the log
+    only fetches a sticker from the API the first time it meets one, or after its entry expired.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries: int = max_entries
+        self.ttl: float = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._names: OrderedDict[int, tuple[str, float]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def get(self, sticker_id: int) -> str | None:
+        entry = self._names.get(sticker_id)
+        if entry is None or entry[1] < time.monotonic():
+            self.misses += 1
+            return None
+        self._names.move_to_end(sticker_id)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, sticker_id: int, name: str):
+        self._names[sticker_id] = (name, time.monotonic() + self.ttl)
+        self._names.move_to_end(sticker_id)
+        while len(self._names) > self.max_entries:
+            self._names.popitem(last=False)
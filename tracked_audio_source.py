@@ -1,4 +1,5 @@
 import io
+from collections import deque
 from typing import Union, Optional
 from typing.io import IO
 import discord
@@ -18,9 +19,21 @@ class TrackedAudioSource(discord.FFmpegPCMAudio):
         super().__init__(source, executable=executable, pipe=pipe, stderr=stderr, before_options=before_options,
                          options=options)
         self.count_20ms = 0
+        self._buffer: deque[bytes] = deque()
+
+    def prebuffer(self, num_frames: int):
+        """Reads up to num_frames 20ms frames ahead of playback, so playing starts without waiting on the stream.
+        Blocking; run it off the event loop, before the source is handed to the voice client."""
+        while len(self._buffer) < num_frames:
+            frame = super().read()
+            if not frame:
+                break
+            self._buffer.append(frame)
 
     def read(self) -> bytes:
         self.count_20ms += 1
+        if len(self._buffer) > 0:
+            return self._buffer.popleft()
         return super().read()
 
     def ms_elapsed(self) -> int: